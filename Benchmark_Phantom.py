@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+# Benchmarks the phantom preprocessing (discovery, metrics, tables, rendering) on a synthetic BIDS tree
+# written by Synthesize_Phantom.py, and compares the timings with an earlier run
+
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+phases = ['discovery', 'T1_metrics', 'fMRI_metrics', 'tables', 'render_fMRI', 'render_coils_nilearn', 'render_coils_fast']
+dependencies = {'tables': ['T1_metrics', 'fMRI_metrics'], 'render_fMRI': ['fMRI_metrics']} # phases that use the results of others
+phase_results = {'T1_metrics': 'metric_cache_Preprocess_Phantom_T1_*.json', 'fMRI_metrics': 'metric_cache_Preprocess_Phantom_fMRI_*.json'} # in the work directory
+
+
+def usage(): # CPU seconds and peak RSS (MB) of this process and of its finished worker processes
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, max(own.ru_maxrss, children.ru_maxrss) / 1024
+
+
+def files_size(files):
+    return sum(Path(f).stat().st_size for f in files)
+
+
+def phase_discovery(bids, work, scanners, jobs, options): # session index from scratch (cold) and from its file (warm)
+    import session_index
+    import Preprocess_Phantom_T1 as T1
+    import Preprocess_Phantom_fMRI as fMRI
+    for scanner in scanners:
+        index_file = Path(bids).joinpath('session_index_%s.json' % scanner)
+        if index_file.exists():
+            index_file.unlink()
+    start = time.perf_counter()
+    files = [f for scanner in scanners for module in (T1, fMRI) for f in module.get_all_files_scanner(scanner)]
+    cold = time.perf_counter() - start
+    session_index._indexes.clear()
+    start = time.perf_counter()
+    for scanner in scanners:
+        session_index.get_index(bids, scanner)
+    return {'items': len(files), 'bytes': files_size(files), 'cold_seconds': cold, 'warm_seconds': time.perf_counter() - start}
+
+
+def phase_metrics(module_name, bids, work, scanners, jobs, options): # the metrics of all files, with an empty metric cache
+    from metric_cache import MetricCache
+    from phantom_render import RenderQueue
+    module = __import__(module_name)
+    files = list()
+    for scanner in scanners:
+        scanner_files = module.get_all_files_scanner(scanner)
+        cache = MetricCache(Path(work).joinpath('metric_cache_%s_%s.json' % (module_name, scanner)), module.metrics_version)
+        cache.entries.clear()
+        if module_name == 'Preprocess_Phantom_fMRI': # figures are queued for render_fMRI
+            renderer = RenderQueue(Path(work).joinpath('render_queue'), 'lazy')
+            module.compute_missing_metrics(scanner_files, cache, jobs, renderer=renderer, streaming=options['streaming'])
+        else:
+            module.compute_missing_metrics(scanner_files, cache, jobs)
+        files += scanner_files
+    return {'items': len(files), 'bytes': files_size(files)}
+
+
+def phase_tables(bids, work, scanners, jobs, options): # store, full_data tables, coil summary and reports from the cached metrics
+    from metric_cache import MetricCache
+    from metrics_store import MetricsStore
+    import Preprocess_Phantom_T1 as T1
+    import Preprocess_Phantom_fMRI as fMRI
+    db_file = Path(work).joinpath('phantom_metrics.db')
+    if db_file.exists():
+        db_file.unlink()
+    store = MetricsStore(db_file)
+    sessions = 0
+    for scanner in scanners:
+        for module in (T1, fMRI):
+            cache = MetricCache(Path(work).joinpath('metric_cache_%s_%s.json' % (module.__name__, scanner)), module.metrics_version)
+            session_files = module.get_session_files(scanner)
+            module.store_sessions(scanner, store, session_files, cache)
+            module.export_full_data(scanner, store)
+            sessions += len(session_files)
+        T1.create_dataframe_scanner_short(scanner, store)
+        manifest_file = Path(bids).joinpath('sub-%s/report_manifest_T1.json' % scanner)
+        if manifest_file.exists():
+            manifest_file.unlink()
+        T1.write_coil_reports(scanner)
+    store.close()
+    return {'items': sessions}
+
+
+def phase_render_fmri(bids, work, scanners, jobs, options): # the fMRI figures queued by the fMRI_metrics phase
+    from phantom_render import RenderQueue
+    renderer = RenderQueue(Path(work).joinpath('render_queue'), 'deferred')
+    pending = renderer.pending()
+    renderer.render_pending(jobs)
+    return {'items': len(pending)}
+
+
+def phase_render_coils(thumbnails, bids, work, scanners, jobs, options): # the coil images of the first sessions, into the work directory
+    import Preprocess_Phantom_T1 as T1
+    from helpers import parallel_map
+    output = Path(work).joinpath('coils_' + thumbnails)
+    output.mkdir(exist_ok=True)
+    sessions = [(scanner, date) for scanner in scanners for date in sorted(T1.get_session_files(scanner))[:options['render_sessions']]]
+    sources = [T1.find_coil_sources(scanner, date) for scanner, date in sessions]
+    sources = [session for session in sources if session is not None]
+    tiles = [[output.joinpath(Path(source).name.replace('.nii.gz', '.png')).as_posix() for source in session] for session in sources]
+    if thumbnails == 'fast':
+        parallel_map(partial(render_session_thumbnails, output), list(zip(sources, tiles)), jobs)
+    else:
+        parallel_map(render_coil, [(source, tile) for session, session_tiles in zip(sources, tiles) for source, tile in zip(session, session_tiles)], jobs)
+    return {'items': sum(len(session) for session in sources)}
+
+
+def render_session_thumbnails(output, session): # one fast thumbnail job (tiles and montage) per session
+    from phantom_render import plot_coil_thumbnails
+    sources, tiles = session
+    plot_coil_thumbnails(Path(tiles[0]).with_name(Path(tiles[0]).stem + '_montage.png').as_posix(), sources, tiles)
+
+
+def render_coil(job): # one nilearn coil image
+    from phantom_render import plot_coil
+    source, tile = job
+    plot_coil(tile, source, Path(source).name)
+
+
+phase_functions = {'discovery': phase_discovery,
+                   'T1_metrics': partial(phase_metrics, 'Preprocess_Phantom_T1'),
+                   'fMRI_metrics': partial(phase_metrics, 'Preprocess_Phantom_fMRI'),
+                   'tables': phase_tables,
+                   'render_fMRI': phase_render_fmri,
+                   'render_coils_nilearn': partial(phase_render_coils, 'nilearn'),
+                   'render_coils_fast': partial(phase_render_coils, 'fast')}
+
+
+def run_phase(phase, bids, work, scanners, jobs, options):
+    """ Runs one phase (in a fresh process, see benchmark) and returns its measurements.
+
+    Returns:
+        result : dict with wall_seconds, cpu_seconds (including worker processes), peak_rss_mb, items,
+            items_per_second and, for phases that read the images, megabytes_per_second
+    """
+    sys.path.insert(0, Path(__file__).resolve().parent.as_posix())
+    import Preprocess_Phantom_T1 as T1
+    import Preprocess_Phantom_fMRI as fMRI
+    T1.default_path = fMRI.default_path = Path(bids)
+    cpu_start, _ = usage()
+    start = time.perf_counter()
+    result = phase_functions[phase](bids, work, scanners, jobs, options)
+    wall = time.perf_counter() - start
+    cpu, peak_rss = usage()
+    result.update({'wall_seconds': wall, 'cpu_seconds': cpu - cpu_start, 'peak_rss_mb': peak_rss,
+                   'items_per_second': result['items'] / wall if wall > 0 else np.nan})
+    if 'bytes' in result:
+        result['megabytes_per_second'] = result.pop('bytes') / 2**20 / wall if wall > 0 else np.nan
+    return result
+
+
+def benchmark(bids, scanners, selected=phases, jobs=1, work=None, **options):
+    """ Runs the selected phases, each in a new process so that its peak memory is its own.
+
+    Phases that use the results of earlier ones (tables and render_fMRI need the metric phases) read them
+    from the work directory, the earlier phases are added when their results are not there.
+
+    Returns:
+        results : dict of phase to measurements (see run_phase)
+    """
+    selected = set(selected)
+    for phase in list(selected):
+        selected.update(dependency for dependency in dependencies.get(phase, []) if not list(Path(work).glob(phase_results[dependency])))
+    results = dict()
+    for phase in [phase for phase in phases if phase in selected]:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results[phase] = executor.submit(run_phase, phase, Path(bids).as_posix(), Path(work).as_posix(), scanners, jobs, options).result()
+        print(format_result(phase, results[phase]), flush=True)
+    return results
+
+
+def format_result(phase, result, baseline=None):
+    line = '%-22s %9.2f s wall %9.2f s cpu %8i items %9.2f items/s %9.1f MB peak' % (
+        phase, result['wall_seconds'], result['cpu_seconds'], result['items'], result['items_per_second'], result['peak_rss_mb'])
+    if 'megabytes_per_second' in result:
+        line += ' %8.1f MB/s' % result['megabytes_per_second']
+    if baseline is not None:
+        line += '  %5.2fx baseline' % (result['wall_seconds'] / baseline['wall_seconds'])
+    return line
+
+
+def is_synthetic(bids): # written by Synthesize_Phantom.py (the benchmark writes tables and reports into the tree)
+    description = Path(bids).joinpath('dataset_description.json')
+    if not description.exists():
+        return False
+    with open(description) as f:
+        return any(generator.get('Name') == 'Synthesize_Phantom.py' for generator in json.load(f).get('GeneratedBy', []))
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser(description='Benchmark of the phantom preprocessing on a synthetic BIDS tree (see Synthesize_Phantom.py)')
+    ap.add_argument("-b", "--bids", required=True, help="the synthetic BIDS directory")
+    ap.add_argument("-s", "--scanners", nargs='+', default=None, help="scanners to process (default: all in the tree)")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes")
+    ap.add_argument("-p", "--phases", nargs='+', choices=phases, default=phases, help="phases to run")
+    ap.add_argument("--streaming", action='store_true', help="read the fMRI runs in chunks")
+    ap.add_argument("--render-sessions", type=int, default=2, help="sessions per scanner for the coil rendering phases")
+    ap.add_argument("--work", default=None, help="directory for the caches, queues and images of the benchmark (default: temporary)")
+    ap.add_argument("-o", "--output", default=None, help="write the results to this JSON file")
+    ap.add_argument("--baseline", default=None, help="results of an earlier run (JSON) to compare with")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown against the baseline that counts as a regression")
+    ap.add_argument("--min-difference", type=float, default=0.5, help="slowdowns of fewer seconds are not regressions (timing noise of short phases)")
+    ap.add_argument("--allow-any-tree", action='store_true', help="also run on a tree that was not written by Synthesize_Phantom.py")
+    args = ap.parse_args()
+
+    if not is_synthetic(args.bids) and not args.allow_any_tree:
+        sys.exit('%s was not written by Synthesize_Phantom.py; the benchmark writes tables and reports into it (use --allow-any-tree on a copy)' % args.bids)
+    scanners = args.scanners or sorted(d.name[len('sub-'):] for d in Path(args.bids).glob('sub-*') if d.is_dir())
+    work = Path(args.work) if args.work is not None else Path(tempfile.mkdtemp(prefix='phantom_benchmark_'))
+    work.mkdir(parents=True, exist_ok=True)
+    try:
+        results = benchmark(args.bids, scanners, args.phases, args.jobs, work,
+                            streaming=args.streaming, render_sessions=args.render_sessions)
+    finally:
+        if args.work is None:
+            shutil.rmtree(work, ignore_errors=True)
+
+    regressions = list()
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print('\nCompared with %s:' % args.baseline)
+        for phase, result in results.items():
+            if phase in baseline:
+                print(format_result(phase, result, baseline[phase]))
+                slowdown = result['wall_seconds'] - baseline[phase]['wall_seconds']
+                if slowdown > baseline[phase]['wall_seconds'] * args.tolerance and slowdown > args.min_difference:
+                    regressions.append(phase)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'bids': Path(args.bids).as_posix(), 'scanners': scanners, 'jobs': args.jobs, 'results': results}, f, indent=1)
+    if regressions:
+        print('Slower than the baseline: ' + ', '.join(regressions))
+        sys.exit(1)
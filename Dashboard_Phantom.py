@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 # This is the main script for the Dash dashboard based on phantom measurements
 
-import webbrowser
-import dash, json
-from dash import dcc, html, MATCH, ALL
+import dash
+from dash import dcc, html, MATCH, ALL, Patch, no_update
+import numpy as np
 import pandas as pd
 import plotly.graph_objs as go
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 import argparse
+import threading
 from pathlib import Path
 from helpers import *
+from phantom_data import DashboardData, qc_types
+from phantom_decimate import decimate, decimation_methods
+from phantom_events import event_marks
+from phantom_render import RenderQueue
+from phantom_reports import add_report_routes
 import os
 
 # setting the path
@@ -17,15 +23,19 @@ default_path = Path('%s/3055010.02/BIDS_data' % ('P:' if os.name == 'nt' else '/
 
 ap = argparse.ArgumentParser()
 ap.add_argument("-p", "--port", default='0', required=False, help="port")
+ap.add_argument("--refresh-interval", type=float, default=30, help="seconds between checks for changes of the data and events.csv")
+ap.add_argument("--webgl", action='store_true', help="draw the temporal plots with WebGL (faster for long histories)")
+ap.add_argument("--max-points", type=int, default=1000,
+                help="most points of a scanner in the visible date window of a temporal plot, longer series are decimated (0: never)")
+ap.add_argument("--decimation", choices=decimation_methods, default='lttb', help="how long series are decimated")
 
-scanners = ['Prisma','Prismafit','Skyra'] # a list of scanner names
-qc_types = {'fMRI':'fMRI','short':'Individual coil check'} # a list of QC types
 # the dictionary of sections defines which plots are created for each QC type
 sections = {'fMRI':
                 [{'name': 'Temporal Signal to Noise Ratio', 'id': 'tSNR'},
                 {'name': 'Ghost to Signal Ratio', 'id': 'GSR', 'ytitle': 'Ghost to Signal Ratio (%)'},
                 {'name': 'Reference Amplitude', 'id': 'ref_amp'},
-                {'name': 'Maximum Displacement', 'id': 'max_displacement', 'ytitle': 'Maximum Displacement (voxels)'}],
+                {'name': 'Maximum Displacement', 'id': 'max_displacement', 'ytitle': 'Maximum Displacement (voxels)'},
+                {'name': 'Radius of Decorrelation', 'id': 'RDC', 'yaxis': 'Radius of Decorrelation (voxels)'}],
             'short':
                 [{'name': 'Maximum deviation from center of mass median from 5 latest measurements', 'id': 'max_dev',
                 'yaxis': 'maximum center of mass deviation (voxels)'},
@@ -38,187 +48,334 @@ sections = {'fMRI':
 args = vars(ap.parse_args())
 port = args['port']
 
-df_list = []
-
-def read_file(path_to_data):
-    """ Read the path (absolute or relative to the default path) or throw an error"""
-    if Path(path_to_data).exists():
-        file_found = True
-    elif default_path.joinpath(path_to_data).exists():
-        path_to_data = default_path.joinpath(path_to_data)
-    else:
-        raise FileNotFoundError('File ' + path_to_data + ' or '+str(default_path.joinpath(path_to_data))+' does not exist')
-    return pd.read_csv(path_to_data)
-
-# Data Preparation - Reading CSV files and adding a scanner column
-for file_type in scanners:
-    for qc_type in qc_types:
-        path_to_data = 'sub-%s/full_data_%s.csv' % (file_type, qc_type)
-        df = read_file(path_to_data)
-        df['scanner'] = file_type
-        df['qc_type'] = qc_type
-        df_list.append(df)
-
-df_events = read_file('events.csv')
-
-# Concatenate data
-full_df = pd.concat(df_list)
-full_df['link'] = full_df.apply(lambda row: default_path.joinpath(
-    'sub-' + row.scanner + '/ses-' + str(row.date) + '_phantom'+('_fMRI' if row.qc_type == 'fMRI' else '')+'.html').__str__(), axis=1)
-full_df["paul_notes"] = ""
-
-# Convert Date to datetime format
-full_df.date = pd.to_datetime(full_df.date, format='%Y%m%d')
+# Data Preparation - the CSV files of all scanners joined with the report links and event notes, from the snapshot
+# written by the pipeline if the CSV files did not change since (see phantom_data.py); the data, the event bars
+# and notes are updated while the dashboard runs when the files change (see refresh_data)
+data = DashboardData(default_path)
 
 # Style components
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
+# the reports and their images are served by the dashboard, figures queued by the preprocessing are rendered when requested
+add_report_routes(app.server, default_path, RenderQueue(default_path.joinpath('render_queue'), 'lazy'))
 
-# Convert dates in events dataframe to actual datetimes
-df_events['date_start'] = pd.to_datetime(df_events['date_start'], format='%d/%m/%Y')
-df_events['date_end'] = pd.to_datetime(df_events['date_end'], format='%d/%m/%Y')
-
-# choose colors based on the scanner id
-def color_switch(argument):
-    switcher = {
-        "Skyra": "Blue",
-        "Prismafit": "Green",
-        "Prisma": "Orange",
-        "Multiple": "Black",
-    }
-    return (switcher.get(argument))
-
-# these "shapes_lines" and annotations are used for the QC notes in the temporal plot later
-shapes_lines = list()
-annotations = list()
-for index, row in df_events.iterrows():
-    color = color_switch(row['scanner'])
-    shapes_lines.append({'type': 'rect',
-                         'xref': 'x',
-                         'yref': 'paper',
-                         'x0': row['date_start'],
-                         'y0': 0.5,
-                         'x1': row['date_end'],
-                         'y1': 0.6,
-                         'line': {'color': color,
-                                  'width': 2
-                                  },
-                         'fillcolor': color,
-                         'opacity': 0.3
-                         })
-
-    annotations.append({'text': row['description'],
-                        'xref': 'x',
-                        'yref': 'paper',
-                        'x': row['date_start'] + (row['date_end'] - row['date_start']) / 2,
-                        'y': .45,
-                        'showarrow': False
-
-                        })
-
-for index, row in df_events.iterrows():
-    if row['scanner'] == 'Multiple':
-        full_df.loc[(full_df['date'] >= row['date_start']) & (full_df['date'] <= row['date_end']), 'paul_notes'] = row[
-            'long_description']
-    full_df.loc[(full_df['date'] >= row['date_start']) & (full_df['date'] <= row['date_end']) & (
-                full_df['scanner'] == row['scanner']), 'paul_notes'] = row['long_description']
-
-
-section_list = [html.Div(id = 'placeholder_for_outputs')]
-
-section_index = -1
-# creates plots for all QC types in a loop
-# for each QC type, there are multiple plots as defined in sections
-for qc_type, qc_type_header in qc_types.items():
-    section_list.append(html.H1(qc_type_header))
-    print(qc_type)
-    df = full_df[full_df['qc_type'] == qc_type]
-
-    for section in sections[qc_type]:
-        section_index += 1
-        title = html.H4(children=section['name'])
-        graph_summary = dcc.Graph(
-            id = {'type': 'point_graph',
-                  'name': section['id'] + '_box'},
-            figure = {
-                'data': [
-                    go.Violin(
-                        y=df[df['scanner'] == i][section['id']],
-                        points='all',
-                        box={"visible": True},
-                        customdata=df.loc[df['scanner'] == i]['link'],
-                        opacity=0.7,
-                        marker={
-                            'size': 10,
-                            'line': {'width': 0.5, 'color': 'white'}
-                        },
-                        name=i
-                    ) for i in df.scanner.unique()
-                ],
-                'layout': go.Layout(
-                    title="Distribution",
-                    yaxis={'title': section['yaxis'] if 'yaxis' in section.keys() else section['name'],
-                           'zeroline': False},
-                    margin={'l': 40, 'b': 40, 't': 30, 'r': 10},
-                    legend={'x': 0, 'y': 1},
-                    hovermode='closest',
-                    clickmode='event'
-                )}
-        )
-
-        graph_temporal = dcc.Graph(
-            id = {'type': 'point_graph',
-                'name': section['id'] + '_temporal'},
-            figure={
-                'data': [
-                    go.Scatter(
-                        x=df[df['scanner'] == i]['date'],
-                        y=df[df['scanner'] == i][section['id']],
-                        mode='lines+markers',
-                        customdata=df.loc[df['scanner'] == i]['link'],
-                        opacity=0.7,
-                        hovertext=df.loc[df['scanner'] == i]['paul_notes'],
-                        marker={
-                            'size': 10,
-                            'line': {'width': 0.5, 'color': 'white'}
-                        },
-                        name=i
-                    ) for i in df.scanner.unique()
-
-                ],
-                'layout': go.Layout(
-                    title=section['name'],
-                    xaxis={'title': 'Date', 'zeroline': False},
-                    yaxis={'title': section['yaxis'] if 'yaxis' in section.keys() else section['name'], 'zeroline': False},
-                    margin={'l': 40, 'b': 40, 't': 30, 'r': 10},
-                    shapes=shapes_lines,
-                    annotations=annotations,
-                    legend={'x': 0, 'y': 1},
-                    hovermode='closest',
-                    clickmode='event'
-                )}
-        )
-        section_list.append(html.Div(
-            [title, html.Div([
-                html.Div(graph_summary, className='six columns', style={'width': '30%'}),
-                html.Div(graph_temporal, className='six columns', style={'width': '65%'})
-            ], className='row')]
-        ))
+scatter = go.Scattergl if args['webgl'] else go.Scatter # the trace type of the temporal plots
+
+figure_cache = dict() # (data version, page version, kind, section id) -> figure, see cached_figure
+figure_cache_lock = threading.Lock()
+
+# the QC type and section of each graph
+graph_sections = {section['id'] + suffix: (qc_type, section) for qc_type in qc_types for section in sections[qc_type]
+                  for suffix in ['_box', '_temporal']}
+
+
+def alert_scanners(df, section_id): # the scanners with a trace of alerts in the temporal plot of the section
+    column = section_id + '_alert'
+    return list(df[df[column] != ''].scanner.unique()) if column in df.columns else []
+
+
+def alert_traces(df, section_id): # red crosses on the sessions with a drift alert, clickable like the other points
+    column = section_id + '_alert'
+    if column not in df.columns:
+        return []
+    df = df[df[column] != '']
+    return [scatter(x=df[df['scanner'] == i]['date'],
+                       y=df[df['scanner'] == i][section_id],
+                       mode='markers',
+                       customdata=df.loc[df['scanner'] == i]['link'],
+                       hovertext=df.loc[df['scanner'] == i][column],
+                       marker={'symbol': 'x', 'size': 14, 'color': 'red'},
+                       name=i + ' alert'
+                       ) for i in df.scanner.unique()]
+
+def latest_alerts(full_df): # the alerts of the latest session of each scanner and QC type
+    alert_columns = [column for column in full_df.columns if column.endswith('_alert')]
+    items = list()
+    for (scanner, qc_type), df in full_df.groupby(['scanner', 'qc_type']):
+        latest = df.sort_values('date').iloc[-1]
+        for column in alert_columns:
+            if latest[column] != '':
+                items.append(html.Li('%s, %s %s: %s' % (scanner, qc_types[qc_type], latest['date'].strftime('%d/%m/%Y'), latest[column])))
+    return [html.H4('Alerts in the latest sessions'), html.Ul(items)] if items else []
+
+
+def distribution_figure(df, section):
+    return {
+        'data': [
+            go.Violin(
+                y=df[df['scanner'] == i][section['id']],
+                points='all',
+                box={"visible": True},
+                customdata=df.loc[df['scanner'] == i]['link'],
+                opacity=0.7,
+                marker={
+                    'size': 10,
+                    'line': {'width': 0.5, 'color': 'white'}
+                },
+                name=i
+            ) for i in df.scanner.unique()
+        ],
+        'layout': go.Layout(
+            title="Distribution",
+            yaxis={'title': section['yaxis'] if 'yaxis' in section.keys() else section['name'],
+                   'zeroline': False},
+            margin={'l': 40, 'b': 40, 't': 30, 'r': 10},
+            legend={'x': 0, 'y': 1},
+            hovermode='closest',
+            clickmode='event'
+        )}
+
+
+def shown_rows(df, section_id, window=None):
+    """ Returns the measurements of a scanner that its temporal trace shows: those in the date window (all if None,
+    and the nearest ones outside it, so that the line reaches the edges), decimated if there are more than --max-points."""
+    if window is not None:
+        df = df.sort_values('date', kind='stable')
+        dates = df['date'].to_numpy('datetime64[ns]')
+        start = max(np.searchsorted(dates, pd.Timestamp(window[0]).to_datetime64(), 'left') - 1, 0)
+        end = np.searchsorted(dates, pd.Timestamp(window[1]).to_datetime64(), 'right') + 1
+        df = df.iloc[start:end]
+    if not args['max_points'] or len(df) <= args['max_points']:
+        return df
+    df = df.sort_values('date', kind='stable')
+    return df.iloc[decimate(df['date'].to_numpy('datetime64[ns]').astype(np.int64).astype(float),
+                            df[section_id].to_numpy(float), args['max_points'], args['decimation'])]
+
+
+def trace_data(df, section_id): # the properties of a trace of measurements
+    return {'x': df['date'], 'y': df[section_id], 'customdata': df['link'], 'hovertext': df['paul_notes']}
+
+
+def temporal_figure(df, section):
+    # these "shapes_lines" and annotations are used for the QC notes in the temporal plot
+    shapes_lines, annotations = event_marks(data.events.df_events)
+    return {
+        'data': [
+            scatter(
+                mode='lines+markers',
+                opacity=0.7,
+                marker={
+                    'size': 10,
+                    'line': {'width': 0.5, 'color': 'white'}
+                },
+                name=i,
+                **trace_data(shown_rows(df[df['scanner'] == i], section['id']), section['id'])
+            ) for i in df.scanner.unique()
+
+        ] + alert_traces(df, section['id']),
+        'layout': go.Layout(
+            title=section['name'],
+            xaxis={'title': 'Date', 'zeroline': False},
+            yaxis={'title': section['yaxis'] if 'yaxis' in section.keys() else section['name'], 'zeroline': False},
+            margin={'l': 40, 'b': 40, 't': 30, 'r': 10},
+            shapes=shapes_lines,
+            annotations=annotations,
+            legend={'x': 0, 'y': 1},
+            hovermode='closest',
+            clickmode='event'
+        )}
+
+
+def figure_traces(df, kind, section):
+    """ Returns per trace of the figure of df (see distribution_figure and temporal_figure) its name, the filter
+    of its rows and the column of each of its properties, in the order of the traces."""
+    if kind == 'distribution':
+        return [(i, lambda df, i=i: df['scanner'] == i, {'y': section['id'], 'customdata': 'link'}) for i in df.scanner.unique()]
+    column = section['id'] + '_alert'
+    return [(i, lambda df, i=i: df['scanner'] == i, {'x': 'date', 'y': section['id'], 'customdata': 'link', 'hovertext': 'paul_notes'})
+            for i in df.scanner.unique()] + \
+           [(i + ' alert', lambda df, i=i: (df['scanner'] == i) & (df[column] != ''),
+             {'x': 'date', 'y': section['id'], 'customdata': 'link', 'hovertext': column})
+            for i in alert_scanners(df, section['id'])]
 
-#print(section_list)
+
+def extend_data(df, version, kind, section):
+    """ Returns the extendData that adds the rows of df added after version to the figure of the rows before,
+    None if the figure needs other traces (e.g. the first alert of a scanner)."""
+    old = df[df['data_version'] <= version]
+    traces = figure_traces(df, kind, section)
+    if [name for name, rows, properties in traces] != [name for name, rows, properties in figure_traces(old, kind, section)]:
+        return None
+    new = df[df['data_version'] > version]
+    updates = dict()
+    indices = list()
+    for index, (name, rows, properties) in enumerate(traces):
+        trace_rows = new[rows(new)]
+        if trace_rows.empty:
+            continue
+        indices.append(index)
+        for key, column in properties.items():
+            updates.setdefault(key, list()).append(trace_rows[column].tolist())
+    return [updates, indices]
+
+
+def cached_figure(full_df, version, page_version, kind, qc_type, section):
+    """ Returns the figure of a section (distribution_figure or temporal_figure) with the sessions up to the page
+    version, built once per version of the data (the cache only keeps the figures of the current version)."""
+    key = (version, page_version, kind, section['id'])
+    with figure_cache_lock:
+        if key in figure_cache:
+            return figure_cache[key]
+    df = full_df[(full_df['qc_type'] == qc_type) & (full_df['data_version'] <= page_version)]
+    figure = distribution_figure(df, section) if kind == 'distribution' else temporal_figure(df, section)
+    with figure_cache_lock:
+        for old_key in [old_key for old_key in figure_cache if old_key[0] != version]:
+            del figure_cache[old_key]
+        figure_cache[key] = figure
+    return figure
+
+
+def serve_layout(): # built for each page load, from the current data; the sections are shown by show_section
+    full_df, version = data.current()
+    section_list = [html.Div(id = 'placeholder_for_outputs'),
+                    dcc.Interval(id='refresh_interval', interval=args['refresh_interval']*1000),
+                    dcc.Store(id='data_version', data={'session': data.session, 'version': version}),
+                    html.Div(id='latest_alerts', children=latest_alerts(full_df))]
+
+    # a tab per section for all QC types, the plots of a section are only built and sent when its tab is selected
+    for qc_type, qc_type_header in qc_types.items():
+        section_list.append(html.H1(qc_type_header))
+        df = full_df[full_df['qc_type'] == qc_type]
+        shown_sections = [section for section in sections[qc_type] if section['id'] in df.columns] # e.g. metrics that were not computed yet
+        if not shown_sections:
+            continue
+        section_list.append(dcc.Tabs(
+            id = {'type': 'section_tabs', 'qc_type': qc_type},
+            value = shown_sections[0]['id'],
+            children = [dcc.Tab(label=section['name'], value=section['id']) for section in shown_sections]
+        ))
+        section_list.append(html.Div(id = {'type': 'section_panel', 'qc_type': qc_type}))
+    return html.Div(children=section_list)
 
 # App Layout
-app.layout = html.Div(children=section_list)
+app.layout = serve_layout
+
+@app.callback(
+    Output(dict(type='section_panel', qc_type=MATCH), 'children'),
+    [Input(dict(type='section_tabs', qc_type=MATCH), 'value')],
+    [State('data_version', 'data')]
+)
+def show_section(section_id, shown):
+    # the plots of the selected section, with the sessions of the version the page shows (later ones are sent by refresh_data)
+    qc_type = dash.callback_context.outputs_list['id']['qc_type']
+    section = next(section for section in sections[qc_type] if section['id'] == section_id)
+    full_df, version, kinds = data.since(shown['session'], shown['version'])
+    page_version = version if kinds is None else shown['version']
+    title = html.H4(children=section['name'])
+    graph_summary = dcc.Graph(
+        id = {'type': 'point_graph',
+              'kind': 'distribution',
+              'name': section['id'] + '_box'},
+        figure = cached_figure(full_df, version, page_version, 'distribution', qc_type, section)
+    )
+
+    graph_temporal = dcc.Graph(
+        id = {'type': 'point_graph',
+            'kind': 'temporal',
+            'name': section['id'] + '_temporal'},
+        figure = cached_figure(full_df, version, page_version, 'temporal', qc_type, section)
+    )
+    return html.Div(
+        [title, html.Div([
+            html.Div(graph_summary, className='six columns', style={'width': '30%'}),
+            html.Div(graph_temporal, className='six columns', style={'width': '65%'})
+        ], className='row')]
+    )
+
+
+@app.callback(
+    [Output(dict(type='point_graph', kind='distribution', name=ALL), 'figure'),
+     Output(dict(type='point_graph', kind='distribution', name=ALL), 'extendData'),
+     Output(dict(type='point_graph', kind='temporal', name=ALL), 'figure'),
+     Output(dict(type='point_graph', kind='temporal', name=ALL), 'extendData'),
+     Output('latest_alerts', 'children'),
+     Output('data_version', 'data')],
+    [Input('refresh_interval', 'n_intervals')],
+    [State('data_version', 'data')],
+    prevent_initial_call=True
+)
+def refresh_data(n_intervals, shown):
+    # sends the changes since the version a page shows: the new sessions as extendData, new event bars and notes
+    # as a patch of the temporal plots, and whole figures after other changes
+    data.refresh()
+    full_df, version, kinds = data.since(shown['session'], shown['version'])
+    outputs = dash.callback_context.outputs_list
+    results = {'distribution': ([no_update] * len(outputs[0]), [no_update] * len(outputs[1])),
+               'temporal': ([no_update] * len(outputs[2]), [no_update] * len(outputs[3]))}
+    if kinds == set():
+        return results['distribution'] + results['temporal'] + (no_update, no_update)
+    if kinds == {'events'}:
+        shapes, descriptions = event_marks(data.events.df_events)
+    for kind, graph_outputs in [('distribution', outputs[0]), ('temporal', outputs[2])]:
+        figures, extensions = results[kind]
+        for k, output in enumerate(graph_outputs):
+            qc_type, section = graph_sections[output['id']['name']]
+            df = full_df[full_df['qc_type'] == qc_type]
+            if kinds == {'events'}:
+                if kind == 'temporal':
+                    figures[k] = Patch()
+                    figures[k]['layout']['shapes'] = shapes
+                    figures[k]['layout']['annotations'] = descriptions
+                    for trace, scanner in enumerate(df.scanner.unique()): # the traces of the measurements come first
+                        for key, values in trace_data(shown_rows(df[df['scanner'] == scanner], section['id']), section['id']).items():
+                            figures[k]['data'][trace][key] = values.tolist()
+                continue
+            extension = extend_data(df, shown['version'], kind, section) if kinds == {'append'} else None
+            if extension is None:
+                figures[k] = cached_figure(full_df, version, version, kind, qc_type, section)
+            elif extension[1]:
+                extensions[k] = extension
+    return results['distribution'] + results['temporal'] + \
+           (latest_alerts(full_df), {'session': data.session, 'version': version})
+
 
 @app.callback(
+    Output(dict(type='point_graph', kind='temporal', name=MATCH), 'figure', allow_duplicate=True),
+    [Input(dict(type='point_graph', kind='temporal', name=MATCH), 'relayoutData')],
+    [State('data_version', 'data')],
+    prevent_initial_call=True
+)
+def zoom_temporal(relayout, shown):
+    # sends the measurements in the visible date window of a temporal plot, at full resolution once it shows at
+    # most --max-points of each scanner; the event bars and alerts stay as they are
+    if relayout is None or not args['max_points']:
+        return no_update
+    if relayout.get('xaxis.autorange'):
+        window = None
+    elif 'xaxis.range[0]' in relayout:
+        window = (relayout['xaxis.range[0]'], relayout['xaxis.range[1]'])
+    elif 'xaxis.range' in relayout:
+        window = tuple(relayout['xaxis.range'])
+    else: # e.g. only the y axis changed
+        return no_update
+    full_df, version, kinds = data.since(shown['session'], shown['version'])
+    if kinds is None or 'replace' in kinds: # the page gets new figures with the next refresh
+        return no_update
+    qc_type, section = graph_sections[dash.callback_context.outputs_list['id']['name']]
+    df = full_df[(full_df['qc_type'] == qc_type) & (full_df['data_version'] <= shown['version'])]
+    if (df.groupby('scanner').size() <= args['max_points']).all(): # the traces show all measurements already
+        return no_update
+    figure = Patch()
+    for trace, scanner in enumerate(df.scanner.unique()): # the traces of the measurements come first
+        for key, values in trace_data(shown_rows(df[df['scanner'] == scanner], section['id'], window), section['id']).items():
+            figure['data'][trace][key] = values.tolist()
+    return figure
+
+
+# opens the report of a clicked point (its URL is the customdata) in a new tab of the browser of the user
+app.clientside_callback(
+    """
+    function(clickData) {
+        const triggered = dash_clientside.callback_context.triggered;
+        if (triggered.length > 0 && triggered[0].value) {
+            window.open(triggered[0].value.points[0].customdata, '_blank');
+        }
+        return JSON.stringify(triggered, null, 2);
+    }
+    """,
     Output('placeholder_for_outputs', 'children'),
-    [Input(dict(type='point_graph', name = ALL), 'clickData')]
+    [Input(dict(type='point_graph', kind=ALL, name=ALL), 'clickData')]
 )
-def callback_function(clickData):
-    #print('clicked clocked')
-    if len(dash.callback_context.triggered)>0 and 'value' in dash.callback_context.triggered[0].keys() and dash.callback_context.triggered[0]['value'] is not None:
-        webbrowser.open_new_tab(dash.callback_context.triggered[0]['value']['points'][0]['customdata'])
-    return json.dumps(dash.callback_context.triggered, indent=2)
 
 
 if port == '0':
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+# Runs the phantom QC from the raw data to the dashboard as a graph of stages, skipping the stages whose inputs did not change
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import traceback
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from pathlib import Path
+
+import Preprocess_Phantom_T1 as T1
+import Preprocess_Phantom_fMRI as fMRI
+from helpers import parallel_map, port_in_use
+from metric_cache import MetricCache
+from metrics_store import MetricsStore
+from nifti_mirror import enable as enable_mirror
+from phantom_data import snapshot_name, source_signature, write_snapshot
+from phantom_render import RenderQueue, render_modes
+from phantom_trace import start as start_trace, traced
+
+default_path = T1.default_path
+raw_path = default_path.parent.joinpath('raw') # the input of the BIDS conversion (Raw2Bids_Phantom.sh)
+shard_dir = default_path.joinpath('shards') # the partial results of the shards of a job array
+modalities = {'T1': T1, 'fMRI': fMRI}
+array_index_variables = ['SLURM_ARRAY_TASK_ID', 'PBS_ARRAYID'] # job array index of the cluster schedulers
+script_dir = Path(__file__).resolve().parent
+
+
+class Stage:
+    """ A step of the pipeline.
+
+    The signature of a stage combines its own inputs (a string, from the inputs function) with the signatures
+    of the stages it depends on. A stage is up to date, and skipped, if its signature is the one stored in the
+    pipeline state after its last successful run and its outputs exist.
+
+    Parameters:
+        name : unique name, also the key in the pipeline state
+        action : function without arguments that runs the stage
+        inputs : function returning a string that describes the inputs, None to run the stage every time
+        deps : names of the stages that have to finish first
+        outputs : files that the stage writes; the stage runs again if one is missing
+    """
+
+    def __init__(self, name, action, inputs=None, deps=(), outputs=()):
+        self.name = name
+        self.action = action
+        self.inputs = inputs
+        self.deps = list(deps)
+        self.outputs = list(outputs)
+
+
+class PipelineState:
+    """ The signatures of the stages after their last successful run, kept in a JSON file."""
+
+    def __init__(self, state_file):
+        self.state_file = Path(state_file)
+        self.signatures = dict()
+        if self.state_file.exists():
+            with open(self.state_file) as f:
+                self.signatures = json.load(f)
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            return self.signatures.get(name)
+
+    def set(self, name, signature): # saved after every stage, so an interrupted run keeps the stages that finished
+        with self.lock:
+            self.signatures[name] = signature
+            tmp_file = self.state_file.with_name(self.state_file.name + '.tmp')
+            with open(tmp_file, 'w') as f:
+                json.dump(self.signatures, f, indent=1)
+            os.replace(tmp_file, self.state_file)
+
+
+def run_stage(stage, dep_signatures, state, force=False, dry_run=False):
+    """ Runs a stage unless it is up to date; returns its signature."""
+    if stage.inputs is None:
+        signature = None
+    else:
+        signature = hashlib.sha1(json.dumps([stage.inputs()] + dep_signatures).encode()).hexdigest()
+        if not force and signature == state.get(stage.name) and all(Path(output).exists() for output in stage.outputs):
+            print('%s: up to date' % stage.name)
+            return signature
+    print('%s: %s' % (stage.name, 'would run' if dry_run else 'running'))
+    if not dry_run:
+        with traced('stage:' + stage.name):
+            stage.action()
+        if signature is not None:
+            state.set(stage.name, signature)
+    return signature
+
+
+def run_pipeline(stages, state, workers=4, force=False, dry_run=False):
+    """ Runs the stages in dependency order, independent stages concurrently in a pool of worker threads.
+
+    Parameters:
+        stages : list of Stage
+        state : the PipelineState
+        workers : number of stages that may run at the same time
+        force : run all stages, even if they are up to date
+        dry_run : only print which stages would run
+
+    Returns:
+        failed : names of the stages that failed or were skipped because a dependency failed
+    """
+    pending = {stage.name: stage for stage in stages}
+    signatures = dict()
+    failed = list()
+    running = dict()
+    with ThreadPoolExecutor(workers) as executor:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                if any(dep in failed for dep in stage.deps):
+                    print('%s: skipped, a dependency failed' % name)
+                    failed.append(name)
+                    del pending[name]
+                elif all(dep in signatures for dep in stage.deps):
+                    future = executor.submit(run_stage, stage, [signatures[dep] for dep in stage.deps], state, force, dry_run)
+                    running[future] = stage
+                    del pending[name]
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                try:
+                    signatures[stage.name] = future.result()
+                except Exception:
+                    traceback.print_exc()
+                    print('%s: failed' % stage.name)
+                    failed.append(stage.name)
+    return failed
+
+
+def raw_signature(): # the raw session directories (two levels) and their modification times
+    if not raw_path.exists():
+        return ''
+    return json.dumps(sorted((d.relative_to(raw_path).as_posix(), d.stat().st_mtime_ns)
+                             for level in raw_path.iterdir() if level.is_dir() for d in [level] + [d for d in level.iterdir() if d.is_dir()]))
+
+
+def files_signature(files, *versions): # the image files of a scanner (path, size and modification time, as in the metric cache) and the versions of the code that reads them
+    return json.dumps([(Path(f).as_posix(), stat.st_size, stat.st_mtime_ns) for f, stat in ((f, os.stat(f)) for f in files)] + list(versions))
+
+
+def start_dashboard(port=0):
+    """ Starts the dashboard on the port (a free one if 0), unless one runs there already: it shows the new data
+    without a restart, so its address stays the same."""
+    if port and port_in_use(port):
+        print('The dashboard on port %i shows the new data' % port)
+        return
+    subprocess.run([sys.executable, 'Dashboard_Phantom.py', '--port', str(port)], cwd=script_dir, check=True)
+
+
+def phantom_stages(scanners, jobs=1, renderer=None, convert=False, dashboard=False, port=0):
+    """ Returns the stages of the phantom QC.
+
+    Per scanner there are two independent branches:
+    T1: coil images -> coil metrics (full_data.csv) -> summary (full_data_short.csv) -> coil reports
+    fMRI: reports -> metrics (full_data_fMRI.csv)
+    They follow the BIDS conversion (if convert) and are followed by the rendering of deferred figures, the
+    snapshot of the dashboard data (phantom_data.py) and the dashboard on the port (if dashboard). The inputs of a
+    branch are the image files of the scanner in the session index, with their sizes and modification times, so a
+    branch only runs if sessions were added, removed or changed (or the metric code version changed). The stages
+    are per scanner, not per session: a branch that runs only processes its new or changed sessions (fingerprints
+    in the metrics store) and files (metric cache).
+    """
+    renderer = renderer or RenderQueue()
+    stages = list()
+    first = list()
+    if convert:
+        stages.append(Stage('convert', lambda: subprocess.run(['sh', 'Raw2Bids_Phantom.sh'], cwd=script_dir, check=True),
+                            raw_signature))
+        first = ['convert']
+    last = list()
+    for scanner in scanners:
+        t1_inputs = lambda scanner=scanner: files_signature(T1.get_all_files_scanner(scanner), T1.metrics_version)
+        fmri_inputs = lambda scanner=scanner: files_signature(fMRI.get_all_files_scanner(scanner), fMRI.metrics_version)
+        subject = default_path.joinpath('sub-' + scanner)
+        stages += [
+            Stage('T1 images %s' % scanner, lambda scanner=scanner: T1.update_all_individual_reports(scanner, jobs, renderer),
+                  t1_inputs, first),
+            Stage('T1 metrics %s' % scanner, lambda scanner=scanner: T1.update_dataframe_scanner(scanner, jobs),
+                  t1_inputs, ['T1 images %s' % scanner], [subject.joinpath('full_data.csv')]),
+            Stage('T1 summary %s' % scanner, lambda scanner=scanner: T1.create_dataframe_scanner_short(scanner),
+                  lambda: '', ['T1 metrics %s' % scanner], [subject.joinpath('full_data_short.csv')]),
+            Stage('T1 reports %s' % scanner, lambda scanner=scanner: T1.write_coil_reports(scanner),
+                  lambda: str(T1.report_version), ['T1 summary %s' % scanner]),
+            Stage('fMRI reports %s' % scanner, lambda scanner=scanner: fMRI.update_all_individual_reports(scanner, jobs),
+                  fmri_inputs, first),
+            Stage('fMRI metrics %s' % scanner, lambda scanner=scanner: fMRI.update_dataframe_scanner(scanner, jobs, renderer=renderer),
+                  fmri_inputs, ['fMRI reports %s' % scanner], [subject.joinpath('full_data_fMRI.csv')])]
+        last += ['T1 reports %s' % scanner, 'fMRI metrics %s' % scanner]
+    if renderer.mode == 'deferred':
+        stages.append(Stage('render', lambda: renderer.render_pending(jobs), None, last))
+        last = ['render']
+    stages.append(Stage('dashboard snapshot', lambda: write_snapshot(default_path), lambda: json.dumps(source_signature(default_path)),
+                        last, [default_path.joinpath(snapshot_name)]))
+    last = ['dashboard snapshot']
+    if dashboard:
+        stages.append(Stage('dashboard', lambda: start_dashboard(port), None, last))
+    return stages
+
+
+def shard_of(scanner, date, shards): # deterministic shard of a session, the same for its T1 and fMRI images
+    return int(hashlib.sha1(('%s/%s' % (scanner, date)).encode()).hexdigest(), 16) % shards
+
+
+def shard_files(shard, shards, scanner=None, modality=None): # the partial store (and metric caches) of a shard
+    suffix = '%iof%i' % (shard, shards)
+    if scanner is None:
+        return shard_dir.joinpath('phantom_metrics_%s.db' % suffix)
+    return shard_dir.joinpath('metric_cache_%s_%s_%s.json' % (modality, scanner, suffix))
+
+
+def parse_shard(text):
+    """ Parses 'i/N' (shard i of N, counted from 0); i may be omitted ('/N') to take it from a job array variable."""
+    index, shards = text.split('/')
+    if index == '':
+        variable = next((v for v in array_index_variables if v in os.environ), None)
+        if variable is None:
+            raise ValueError('No shard index given and none of %s is set' % ', '.join(array_index_variables))
+        index = os.environ[variable]
+    index, shards = int(index), int(shards)
+    if not 0 <= index < shards:
+        raise ValueError('Shard index %i is not in 0..%i' % (index, shards-1))
+    return index, shards
+
+
+def run_shard(scanners, shard, shards, jobs=1, renderer=None):
+    """ Computes the metrics, images and fMRI reports of the sessions of one shard (deferred figures are only queued).
+
+    The metrics are written to a partial store of the shard, which is only renamed to its final name when
+    the shard is complete; new metric cache entries go to cache files of the shard. Nothing that other shards
+    write to is touched, merge_shards combines the results.
+    """
+    renderer = renderer or RenderQueue()
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    db_file = shard_files(shard, shards)
+    tmp_file = db_file.with_name(db_file.name + '.tmp')
+    if tmp_file.exists():
+        tmp_file.unlink() # left by an earlier, interrupted run of this shard
+    store = MetricsStore(tmp_file)
+    for scanner in scanners:
+        for modality, module in modalities.items():
+            session_files = module.get_session_files(scanner)
+            dates = [date for date in sorted(session_files) if shard_of(scanner, date, shards) == shard]
+            print('%s %s shard %i/%i: %s' % (scanner, modality, shard, shards, ', '.join(dates)))
+            cache = MetricCache(shard_files(shard, shards, scanner, modality), module.metrics_version,
+                                base_file=module.get_metric_cache(scanner).cache_file)
+            if modality == 'T1':
+                parallel_map(partial(T1.create_plot_32_coils, scanner, renderer=renderer), dates, jobs)
+                T1.store_sessions(scanner, store, {date: session_files[date] for date in dates}, cache, jobs)
+            else:
+                parallel_map(partial(fMRI.create_report, scanner), dates, jobs)
+                fMRI.store_sessions(scanner, store, {date: session_files[date] for date in dates}, cache, jobs, renderer=renderer)
+    store.close()
+    os.replace(tmp_file, db_file)
+
+
+def merge_shards(scanners, jobs=1, renderer=None):
+    """ Merges the complete shards into the main store and metric caches, then writes the tables and coil reports.
+
+    Merged shard files are removed. Missing shards are reported; their sessions are processed by the next
+    normal (incremental) run. In deferred mode the figures queued by the shards are rendered here.
+    """
+    renderer = renderer or RenderQueue()
+    db_files = sorted(shard_dir.glob('phantom_metrics_*of*.db')) if shard_dir.exists() else []
+    for shards in sorted({int(f.stem.split('of')[-1]) for f in db_files}):
+        missing = [i for i in range(shards) if not shard_files(i, shards).exists()]
+        if missing:
+            warnings.warn('Shards %s of %i are missing or not finished' % (', '.join(map(str, missing)), shards))
+    store = MetricsStore(default_path.joinpath('phantom_metrics.db'))
+    for db_file in db_files:
+        shard = MetricsStore(db_file)
+        for scanner in scanners:
+            for modality in modalities:
+                rows = shard.frame(scanner, modality)
+                store.write_sessions(scanner, modality, rows[['date', 'coil', 'metric', 'value']].itertuples(index=False),
+                                     shard.processed_sessions(scanner, modality))
+        shard.close()
+    for scanner in scanners:
+        for modality, module in modalities.items():
+            cache = module.get_metric_cache(scanner)
+            for cache_file in sorted(shard_dir.glob('metric_cache_%s_%s_*of*.json' % (modality, scanner))) if shard_dir.exists() else []:
+                cache.update(MetricCache(cache_file, module.metrics_version))
+            cache.save()
+        T1.export_full_data(scanner, store)
+        T1.create_dataframe_scanner_short(scanner, store)
+        T1.write_coil_reports(scanner)
+        fMRI.export_full_data(scanner, store)
+    store.close()
+    for f in db_files:
+        f.unlink()
+    for f in shard_dir.glob('metric_cache_*of*.json') if shard_dir.exists() else []:
+        f.unlink()
+    if renderer.mode == 'deferred':
+        renderer.render_pending(jobs)
+
+
+def run_local_shards(shards, arguments):
+    """ Runs all shards as local subprocesses of this script (e.g. to test a job array), then merges them."""
+    processes = [subprocess.Popen([sys.executable, Path(__file__).resolve().as_posix(), '--shard', '%i/%i' % (i, shards)] + arguments)
+                 for i in range(shards)]
+    return [process.wait() for process in processes]
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser(description='Phantom QC pipeline: BIDS conversion, preprocessing, reports and dashboard')
+    ap.add_argument("-s", "--scanners", nargs='+', default=['Skyra','Prismafit','Prisma'], help="scanners to process")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes per stage for the files and reports")
+    ap.add_argument("-w", "--workers", type=int, default=4, help="number of stages that run at the same time")
+    ap.add_argument("--convert", action='store_true', help="run the BIDS conversion (Raw2Bids_Phantom.sh) first")
+    ap.add_argument("--dashboard", action='store_true', help="start the dashboard at the end")
+    ap.add_argument("-p", "--port", type=int, default=0,
+                    help="port of the dashboard (a free one if 0); a dashboard that runs there already is not restarted")
+    ap.add_argument("--force", action='store_true', help="run all stages, even if they are up to date")
+    ap.add_argument("--dry-run", action='store_true', help="only print which stages would run")
+    ap.add_argument("--render", choices=render_modes, default='inline',
+                    help="render the figures with the metrics (inline), in a pool after the preprocessing (deferred) or when first needed (lazy)")
+    ap.add_argument("--dpi", type=int, default=None, help="resolution of the figures")
+    ap.add_argument("--thumbnails", choices=['nilearn', 'fast'], default='nilearn', help="how the coil images are plotted")
+    ap.add_argument("--mirror", default=None, help="local directory for uncompressed, memory-mapped copies of the NIfTI files")
+    ap.add_argument("--mirror-size", type=float, default=50, help="size limit of the mirror in GB")
+    ap.add_argument("--shard", default=None,
+                    help="only compute the sessions of shard i of N ('i/N', from 0), for a job array; with '/N' the index is taken from %s" % ' or '.join(array_index_variables))
+    ap.add_argument("--merge", action='store_true', help="merge the results of the shards and write the tables and reports")
+    ap.add_argument("--local-shards", type=int, default=None, help="run N shards as local subprocesses and merge them")
+    ap.add_argument("--trace", default=None,
+                    help="record time, CPU, bytes read and peak memory per stage and file in this file (JSON lines, or a Chrome trace if it ends with .json)")
+    args = ap.parse_args()
+    if args.mirror is not None:
+        enable_mirror(args.mirror, args.mirror_size)
+    if args.trace is not None: # local shards inherit the trace
+        start_trace(args.trace)
+
+    renderer = RenderQueue(default_path.joinpath('render_queue'), args.render, args.dpi, args.thumbnails)
+    if args.shard is not None:
+        shard, shards = parse_shard(args.shard)
+        run_shard(args.scanners, shard, shards, args.jobs, renderer)
+        sys.exit(0)
+    if args.local_shards is not None:
+        shard_arguments = ['-s'] + args.scanners + ['-j', str(args.jobs), '--render', args.render, '--thumbnails', args.thumbnails]
+        if args.dpi is not None:
+            shard_arguments += ['--dpi', str(args.dpi)]
+        if any(run_local_shards(args.local_shards, shard_arguments)):
+            print('Not all shards finished, merging the finished ones')
+    if args.merge or args.local_shards is not None:
+        merge_shards(args.scanners, args.jobs, renderer)
+        sys.exit(0)
+    stages = phantom_stages(args.scanners, args.jobs, renderer, args.convert, args.dashboard, args.port)
+    failed = run_pipeline(stages, PipelineState(default_path.joinpath('pipeline_state.json')), args.workers, args.force, args.dry_run)
+    if failed:
+        print('Failed stages: ' + ', '.join(failed))
+        sys.exit(1)
@@ -5,266 +5,321 @@ Spyder Editor
 This is a temporary script file.
 """
 import warnings
+import argparse
+import hashlib
+import json
+import os
+import numpy as np
 from os import path
-import re
 from scipy import ndimage
 import glob
-import dateutil.parser as dparser
 import datetime
 import pandas as pd
-import math
-from nilearn import plotting
-import nibabel as nib
 from pathlib import Path
+from string import Template
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from helpers import parallel_map
+from metric_cache import MetricCache
+from metrics_store import MetricsStore, session_fingerprint
+from nifti_mirror import enable as enable_mirror, load_nifti
+from phantom_drift import alert_columns, update_drift
+from phantom_metrics import centers_of_mass
+from phantom_render import RenderQueue, render_modes
+from phantom_trace import start as start_trace, traced
+from session_index import get_index, lookup, parse_date
 
 pd.set_option('display.max_colwidth', None)
 default_path = Path('/project/3055010.02/BIDS_data')
+metrics_version = 1 # increase when the metric computation changes, this invalidates the metric cache
+
+
+coils = ["%.2d" % i for i in range(1,33)] #coil list
+coil_features = ['center_of_mass_x','center_of_mass_y','center_of_mass_z','signal_proportion'] #per coil columns of full_data.csv
+full_data_columns = [feature+'_C'+coil for coil in coils for feature in coil_features] #the columns of full_data.csv
+
+# the coil report of a session, written once from these templates (increase report_version when they change)
+report_version = 1
+report_template = Template('''<style>table, tr, td {border: 1px solid black;}#biggest{border: 2px solid #FF0000;}</style>
+<table border="1" class="dataframe">
+  <tbody>
+$rows
+  </tbody>
+</table>
+''')
+row_template = Template('''    <tr>
+$cells
+    </tr>''')
+cell_template = Template('      <td><img src="$src" /></td>')
+highlight_cell_template = Template('      <td bgcolor="#FF0000" id="biggest"><img src="$src" /></td>')
+
+
+def coil_array(df): #gets a dates x coils x features array from the per coil columns of the table
+    return np.stack([df[[feature+'_C'+coil for coil in coils]].to_numpy(dtype=float) for feature in coil_features], axis=2)
+
+
+def normalize_signal_proportions(df): #divides each coil signal by the sum over the coils of that date, missing coils stay NaN
+    columns = ['signal_proportion_C'+coil for coil in coils]
+    signal = df[columns].to_numpy(dtype=float)
+    df[columns] = signal/np.nansum(signal, axis=1, keepdims=True)
+
+
+def rolling_median(data, window): #median over the current and previous window-1 dates (first axis), NaN if any of them is NaN (like pandas rolling)
+    median = np.full(data.shape, np.nan)
+    if len(data) >= window:
+        median[window-1:] = np.median(np.lib.stride_tricks.sliding_window_view(data, window, axis=0), axis=-1)
+    return median
+
+
+def last_max(values): #maximum over the coils (second axis) per date and the last coil that reaches it, NaN ignored (0 and the first coil if all are NaN)
+    filled = np.where(np.isnan(values), -np.inf, values)
+    index = values.shape[1]-1-np.argmax(filled[:,::-1], axis=1)
+    maximum = filled[np.arange(len(values)), index]
+    found = maximum >= 0
+    return np.where(found, maximum, 0), np.where(found, index, 0)
 
 
 def data_array(file) : #calculates center of mass and signal sum
-  img = nib.load(file)  #reads image file
+  img = load_nifti(file)  #reads image file (through the local mirror if enabled)
   data = img.get_fdata() #gets matrix type structure from image
-  return  ndimage.measurements.center_of_mass(data),sum(sum(sum(data))) # gets measurments in question - add stuff in this line for more metrics
+  return  ndimage.measurements.center_of_mass(data),data.sum() # gets measurments in question - add stuff in this line for more metrics
+
+
+def load_coil_stack(files): #loads the coil images of a session into one array (coils on the last axis), decompressing them in parallel threads
+  with ThreadPoolExecutor(max_workers=min(len(files), 8)) as executor:
+      volumes = list(executor.map(lambda file: load_nifti(file).get_fdata(), files))
+  if len(set(volume.shape for volume in volumes)) > 1:
+      return None
+  return np.stack(volumes, axis=-1)
+
+
+def session_coil_metrics(files): #calculates center of mass and signal sum of all coil images of a session at once
+  session = Path(files[0]).parent
+  with traced('load', session, files=len(files)):
+      stack = load_coil_stack(files)
+  with traced('centroids', session, files=len(files)):
+      if stack is None: # coil images of different sizes can't be stacked, fall back to one at a time
+          results = [data_array(file) for file in files]
+          return np.array([center_of_mass for center_of_mass, signal in results]), np.array([signal for center_of_mass, signal in results])
+      return centers_of_mass(stack), stack.sum(axis=(0,1,2))
+
+
+def get_metric_cache(scanner): #the cache with the metrics of all coil files of a scanner
+    return MetricCache(default_path.joinpath('sub-'+scanner+'/metric_cache_T1.json'), metrics_version)
+
+
+def compute_missing_metrics(files, cache, jobs=1): #computes the metrics of new or changed files only (in parallel with jobs>1) and stores them in the cache
+    missing = [file for file in files if cache.get(file) is None]
+    sessions = dict() #missing files grouped by session, each session is computed as one stack
+    for file, date in zip(missing, get_date_from_file_list(missing)[0]):
+        sessions.setdefault(date, list()).append(file)
+    results = parallel_map(session_coil_metrics, list(sessions.values()), jobs)
+    for session_files, (centers, signals) in zip(sessions.values(), results):
+        for file, center_of_mass, signal in zip(session_files, centers, signals):
+            cache.put(file, {'center_of_mass_x':center_of_mass[0],'center_of_mass_y':center_of_mass[1],
+                             'center_of_mass_z':center_of_mass[2],'signal':signal})
+    cache.save()
 
 
 def get_all_files_scanner(scanner): #gets all files from a specific scanner
-    files = list() #list of files
-    coils = ["%.2d" % i for i in range(1,33)] #coil list
-    filename_pattern = re.compile(".*grecoilCheck(C|cH)\d+_run-1_T1w.nii")
-    files = [f for f in default_path.joinpath('sub-' + scanner).glob('**/anat/*grecoilCheck*_run-1_T1w.nii.gz') if filename_pattern.match(f.as_posix())]
-    return files
-
-def filter_file_list_scanner_after(scanner,date): #gets all files from a specific scanner after a specific date
-    files=get_all_files_scanner(scanner)
-    files_filtered = list()
-    for file in files:
-        match_date = re.search(r'\d{8}_acq', file.as_posix()) #gets dates from file names
-        match_date = dparser.parse(match_date.group(0),fuzzy=True)
-        if match_date>datetime.datetime.strptime(str(date), '%Y%m%d'): #This is where the filtering happens
-            files_filtered.append(file)
-    return files_filtered
- 
-def filter_file_list_scanner_before(scanner,date): #gets all files from a specific scanner before a specific date (same as previous but different filter)
-    files=get_all_files_scanner(scanner)
-    files_filtered = list()
-    for file in files:
-        match_date = re.search(r'\d{8}_acq', file.as_posix())
-        match_date = dparser.parse(match_date.group(0),fuzzy=True)
-        if match_date<datetime.datetime.strptime(str(date), '%Y%m%d'):
-            files_filtered.append(file)
-    return files_filtered
-    
+    with traced('discovery', scanner=scanner, modality='T1'):
+        return [f for f, entry in get_index(default_path, scanner).select(datatype='anat', suffix='T1w', run='1') if entry['coil'] is not None]
 
-def create_plot_32_coils(scanner,date): #creates html code that has the correct structure for a given scanner and date - plots the image of each of the 32 coil images
-    coil_images = dict() # creates a dictionary that will hold the html code for each image
-    coils = ["%.2d" % i for i in range(1,33)]  #coil list
-    for coil in coils:
-        img_path = default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'/anat/sub-'+scanner+'_ses-'+str(date)+'_acq-grecoilCheckC'+coil+'_run-1_T1w.png')
+def get_session_files(scanner): #gets the files of a scanner grouped by session date (YYYYMMDD)
+    files = get_all_files_scanner(scanner)
+    sessions = dict()
+    for file, date in zip(files, get_date_from_file_list(files)[0]):
+        sessions.setdefault(datetime.date.strftime(date,'%Y%m%d'), list()).append(file)
+    return sessions
 
-        source_path = [f for f in default_path.joinpath('sub-' + scanner + '/ses-' + str(date) + '/anat/').glob('sub-%s_ses-%s_acq-grecoilCheck*%i_run-1_T1w.nii.gz' % ( scanner,str(date),int(coil)))
-                       if re.search('grecoilCheck(C|cH)0?%i_run-1_T1w' % int(coil), f.as_posix())]
 
-        if len(source_path)==0:
-            warnings.warn('GRE coil check files missing in '+default_path.joinpath('sub-' + scanner + '/ses-' + str(date) + '/anat/').as_posix())
-            return
+def coil_image_path(scanner, date, coil): #the png of one coil image of a session
+    return default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'/anat/sub-'+scanner+'_ses-'+str(date)+'_acq-grecoilCheckC'+coil+'_run-1_T1w.png')
 
-        source_path = source_path[0].as_posix()
+def find_coil_sources(scanner, date): #gets the coil image files of a session in coil order, None (with a warning) if any is missing
+    session_files = {entry['coil']: f.as_posix() for f, entry in get_index(default_path, scanner).select(datatype='anat', suffix='T1w', run='1', date=str(date))}
+    if any(int(coil) not in session_files for coil in coils):
+        warnings.warn('GRE coil check files missing in '+default_path.joinpath('sub-' + scanner + '/ses-' + str(date) + '/anat/').as_posix())
+        return None
+    return [session_files[int(coil)] for coil in coils]
 
-        coil_images[coil]='<img src="'+img_path.as_posix()+'" />' #html code to link to an image
+def create_plot_32_coils(scanner,date,renderer=None): #plots (or queues) the image of each of the 32 coil images of a given scanner and date that does not exist yet
+    sources = find_coil_sources(scanner, date)
+    if sources is None:
+        return
+    renderer = renderer or RenderQueue()
+    missing_coils, missing_sources, missing_images = list(), list(), list() # coil images that still have to be plotted
+    for coil, source_path in zip(coils, sources):
+        img_path = coil_image_path(scanner, date, coil)
         if not img_path.exists(): #only creates image if it doesnt exist yet
-            plotting.plot_anat(anat_img=source_path,display_mode='z',cut_coords=1,
-                           output_file=img_path.as_posix(),title='C'+coil)# creates the plot
-  
-    df=pd.DataFrame(data=coil_images.items()) #dataframe from dictionary
-    df=df.drop(columns=[0])# drop first column
-    #Remaining formatting for the html file
-    col=[1,1,1,1,1,1,1,1,2,2,2,2,2,2,2,2,3,3,3,3,3,3,3,3,4,4,4,4,4,4,4,4]
-    df['col']=col
-    df=df.pivot_table(df,index='col',aggfunc=lambda x: '  '.join(str(v) for v in x))
-    df.columns=['Name']
-    df=df.Name.str.split("  ",expand=True,)
-    df.to_html(default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'_phantom.html'),escape=False, header=False, index=False)
+            missing_coils.append(coil)
+            missing_sources.append(source_path)
+            missing_images.append(img_path.as_posix())
+
+    if renderer.thumbnails == 'fast': # all missing tiles (and the session montage) in one job, reading only one slice per coil
+        if missing_images:
+            montage_path = default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'/anat/sub-'+scanner+'_ses-'+str(date)+'_acq-grecoilCheckMontage_run-1_T1w.png')
+            renderer.submit('coil_thumbnails', montage_path.as_posix(), products=missing_images,
+                            sources=missing_sources, tiles=missing_images)
+    else:
+        for coil, source_path, img_path in zip(missing_coils, missing_sources, missing_images):
+            renderer.submit('coil', img_path, source=source_path, title='C'+coil) # creates (or queues) the plot
+
+def coil_report_html(scanner, date, worst_coil=None): #html of the report of a session: the 32 coil images in 4 rows, the worst coil (if known) highlighted
+    cells = [(highlight_cell_template if coil == worst_coil else cell_template).substitute(src=coil_image_path(scanner, date, coil).as_posix())
+             for coil in coils]
+    rows = [row_template.substitute(cells='\n'.join(cells[i:i+8])) for i in range(0, len(cells), 8)]
+    return report_template.substitute(rows='\n'.join(rows))
+
+def get_report_manifest(scanner): #the hashes of the inputs of the written coil reports of a scanner, by date
+    manifest_file = default_path.joinpath('sub-'+scanner+'/report_manifest_T1.json')
+    if not manifest_file.exists():
+        return dict()
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_report_manifest(scanner, manifest):
+    manifest_file = default_path.joinpath('sub-'+scanner+'/report_manifest_T1.json')
+    tmp_file = manifest_file.with_name(manifest_file.name + '.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
+
+def write_coil_reports(scanner): #writes the report of every session whose inputs (coil images, worst coil, template) changed since it was written
+    df_full=pd.read_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'),index_col=0)
+    df_short=pd.read_csv(default_path.joinpath('sub-'+scanner+'/full_data_short.csv'),converters={'coil': lambda x: str(x)})
+    worst_coils = dict(zip(df_short['date'].astype(str), df_short['coil'])) # not defined for the first sessions
+    manifest = get_report_manifest(scanner)
+    written = 0
+    for date in df_full.index.astype(str):
+        report = default_path.joinpath('sub-'+scanner+'/ses-'+date+'_phantom.html')
+        inputs = json.dumps({'template': report_version, 'worst_coil': worst_coils.get(date),
+                             'images': [coil_image_path(scanner, date, coil).as_posix() for coil in coils]})
+        input_hash = hashlib.sha1(inputs.encode()).hexdigest()
+        if manifest.get(date) == input_hash and report.exists():
+            continue
+        if find_coil_sources(scanner, date) is None:
+            continue
+        with traced('report_write', report):
+            report.write_text(coil_report_html(scanner, date, worst_coils.get(date)))
+        manifest[date] = input_hash
+        written += 1
+    save_report_manifest(scanner, manifest)
+    print('%i coil reports written' % written)
 
 def get_date_from_file_list(files): #gets list of dates and coils from files
     dates=list()
     coils=list()
     for file in files:
-        match_date = re.search(r'\d{8}_acq', file.as_posix())
-        match_coil = re.search(r'(C|cH)(\d{1,2})', file.as_posix())
-        match_date = dparser.parse(match_date.group(0),fuzzy=True)
-        match_coil = match_coil.group(2)
-        dates.append(match_date.date())
-        coils.append(match_coil)
+        entry = lookup(default_path, file)
+        dates.append(parse_date(entry['date']))
+        coils.append('%.2d' % entry['coil'])
     return dates,coils
 
-def create_dataframe_scanner(scanner):
-    files= get_all_files_scanner(scanner)
-    file_dates,file_coils = get_date_from_file_list(files)
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    center_of_mass_x_col = ["center_of_mass_x_C"+"%.2d" % i for i in range(1,33)]
-    center_of_mass_y_col = ["center_of_mass_y_C"+"%.2d" % i for i in range(1,33)]
-    center_of_mass_z_col = ["center_of_mass_z_C"+"%.2d" % i for i in range(1,33)]
-    proportion_col = ["signal_proportion_C"+"%.2d" % i for i in range(1,33)]
-    lists = [center_of_mass_x_col,center_of_mass_y_col,center_of_mass_z_col,proportion_col]
-    col_names=[val for tup in zip(*lists) for val in tup]
-    df = pd.DataFrame(columns=col_names,index=dates_df)
-    i=0
-    for file in files:
-        center_of_mass,signal=data_array(file)
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"center_of_mass_x_C"+file_coils[i]]=center_of_mass[0]
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"center_of_mass_y_C"+file_coils[i]]=center_of_mass[1]
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"center_of_mass_z_C"+file_coils[i]]=center_of_mass[2]
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"signal_proportion_C"+file_coils[i]]=signal
-        i=i+1
-    coils = ["%.2d" % i for i in range(1,33)]
-    for index, row in df.iterrows():
-        signal_coils = 0
-        for coil in coils:
-            if not math.isnan(row["signal_proportion_C"+coil]):
-                signal_coils = signal_coils+row["signal_proportion_C"+coil]
-        for coil in coils:
-            if not math.isnan(row["signal_proportion_C"+coil]):
-                df.loc[index,"signal_proportion_C"+coil]=row["signal_proportion_C"+coil]/signal_coils
-    df=df.sort_index()
+def get_metrics_store(): #the store with the metrics of all scanners and sessions
+    return MetricsStore(default_path.joinpath('phantom_metrics.db'))
+
+def session_metric_rows(session_files, cache): #the cached metrics of the coils of some sessions as (date, coil, metric, value) rows
+    for date, files in session_files.items():
+        for file, coil in zip(files, get_date_from_file_list(files)[1]):
+            for metric, value in cache.get(file).items():
+                yield date, coil, metric, value
+
+def export_full_data(scanner, store): #updates the drift statistics and writes full_data.csv (one row per session, one column per coil and feature) from the store
+    df = store.wide(scanner, 'T1')
+    df.columns = [column.replace('signal_C', 'signal_proportion_C') for column in df.columns]
+    df = df.reindex(columns=full_data_columns)
+    normalize_signal_proportions(df)
+    with traced('drift', scanner=scanner, modality='T1'):
+        update_drift(store, scanner, 'T1', df) # per coil and feature, only the sessions after the stored drift state
     df.index.names = ['date']
-    df.to_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'))
-
-def create_all_individual_reports(scanner):
-    files= get_all_files_scanner(scanner)
-    file_dates,file_coils = get_date_from_file_list(files) 
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    dates_df = list(map(int, dates_df))
-    for dates in dates_df:
-        print (str(dates))
-        create_plot_32_coils(scanner,dates)
-
-def update_dataframe_scanner(scanner):
-    df_full=pd.read_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'),index_col=0)
-    first_date = df_full.index[0]
-    files_before=filter_file_list_scanner_before(scanner,first_date)
-    last_date = df_full.index[-1]
-    files_after=filter_file_list_scanner_after(scanner,last_date)
-    files=files_before+files_after
-    file_dates,file_coils = get_date_from_file_list(files)
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    center_of_mass_x_col = ["center_of_mass_x_C"+"%.2d" % i for i in range(1,33)]
-    center_of_mass_y_col = ["center_of_mass_y_C"+"%.2d" % i for i in range(1,33)]
-    center_of_mass_z_col = ["center_of_mass_z_C"+"%.2d" % i for i in range(1,33)]
-    proportion_col = ["signal_proportion_C"+"%.2d" % i for i in range(1,33)]
-    lists = [center_of_mass_x_col,center_of_mass_y_col,center_of_mass_z_col,proportion_col]
-    col_names=[val for tup in zip(*lists) for val in tup]
-    df = pd.DataFrame(columns=col_names,index=dates_df)
-    i=0
-    for file in files:
-        center_of_mass,signal=data_array(file)
-        file_coils[i] = '%02i' % int(file_coils[i])
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"center_of_mass_x_C"+file_coils[i]]=center_of_mass[0]
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"center_of_mass_y_C"+file_coils[i]]=center_of_mass[1]
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"center_of_mass_z_C"+file_coils[i]]=center_of_mass[2]
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),"signal_proportion_C"+file_coils[i]]=signal
-        i=i+1
-    coils = ["%.2d" % i for i in range(1,33)]
-    for index, row in df.iterrows():
-        signal_coils = 0
-        for coil in coils:
-            if not math.isnan(row["signal_proportion_C"+coil]):
-                signal_coils = signal_coils+row["signal_proportion_C"+coil]
-        for coil in coils:
-            if not math.isnan(row["signal_proportion_C"+coil]):
-                df.loc[index,"signal_proportion_C"+coil]=row["signal_proportion_C"+coil]/signal_coils
-    df.index=pd.Index.astype(df.index,'int')
-    df_full=df_full.append(df)
-    df_full=df_full.sort_index()
-    df_full.index.names = ['date']
-    df_full.to_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'))
+    with traced('table_write', default_path.joinpath('sub-'+scanner+'/full_data.csv')):
+        df.to_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'))
+
+def create_dataframe_scanner(scanner, jobs=1): #stores the metrics of all sessions again (the metric cache still applies)
+    store = get_metrics_store()
+    store.clear(scanner, 'T1')
+    store.close()
+    update_dataframe_scanner(scanner, jobs)
+
+def create_all_individual_reports(scanner, jobs=1, renderer=None):
+    dates_df = list(map(int, sorted(get_session_files(scanner))))
+    print (', '.join(map(str, dates_df)))
+    parallel_map(partial(create_plot_32_coils, scanner, renderer=renderer), dates_df, jobs)
+
+def update_dataframe_scanner(scanner, jobs=1): #processes the sessions that are new or have other files than when they were stored, wherever they are in the history
+    session_files = get_session_files(scanner)
+    store = get_metrics_store()
+    new_sessions = {date: session_files[date] for date in store.new_sessions(scanner, 'T1', session_files)}
+    store_sessions(scanner, store, new_sessions, get_metric_cache(scanner), jobs)
+    export_full_data(scanner, store)
+    store.close()
+
+def store_sessions(scanner, store, session_files, cache, jobs=1): #computes the metrics of some sessions (dict of date to files) and writes them to the store
+    compute_missing_metrics([file for files in session_files.values() for file in files], cache, jobs)
+    with traced('store_write', store.db_file, scanner=scanner, modality='T1', sessions=len(session_files)):
+        store.write_sessions(scanner, 'T1', session_metric_rows(session_files, cache),
+                             {date: session_fingerprint(files) for date, files in session_files.items()})
     
     
-def update_all_individual_reports(scanner):
-    df_full=pd.read_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'),index_col=0)
-    first_date = df_full.index[0]
-    files_before=filter_file_list_scanner_before(scanner,first_date)
-    last_date = df_full.index[-1]
-    files_after=filter_file_list_scanner_after(scanner,last_date)
-    files=files_before+files_after
-    file_dates,file_coils = get_date_from_file_list(files)
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    dates_df = list(map(int, dates_df))
-    for dates in dates_df:
-        print (str(dates))
-        create_plot_32_coils(scanner,dates)
+def update_all_individual_reports(scanner, jobs=1, renderer=None): #plots the coil images of the sessions that are not in the store yet (run before update_dataframe_scanner)
+    session_files = get_session_files(scanner)
+    store = get_metrics_store()
+    dates_df = list(map(int, store.new_sessions(scanner, 'T1', session_files)))
+    store.close()
+    print (', '.join(map(str, dates_df)))
+    parallel_map(partial(create_plot_32_coils, scanner, renderer=renderer), dates_df, jobs)
         
-def add_marks_worst_coil(scanner):
-     df=pd.read_csv(default_path.joinpath('sub-'+scanner+'/full_data_short.csv'),converters={'coil': lambda x: str(x)})
-     df['date'] = df['date'].astype(str)
-     df['link']= df.apply(lambda row: default_path.joinpath('sub-'+scanner+'/ses-'+str(row.date)+'_phantom.html'),axis=1)
-
-     for row in df.iterrows():
-         if not Path(row[1].link).exists():
-             warnings.warn('File %s does not exist, trying to recreate' % row[1].link)
-             create_plot_32_coils(scanner, row[1].date)
-             if not Path(row[1].link).exists():
-                warnings.warn('Wasn\'t able to create %s, skipping' % row[1].link)
-             else:
-                 print('File successfully created')
-
-             continue
-         with open(row[1].link, 'r') as f:
-             html_string = f.read()
-             html_string = "<style>table, tr, td {border: 1px solid black;}#biggest{border: 2px solid #FF0000;}</style> \n"+html_string
-             path_to_img = default_path.joinpath('sub-'+scanner+'/ses-'+row[1].date+'/anat/sub-'+scanner+'_ses-'+row[1].date+'_acq-grecoilCheckC'+row[1].coil+'_run-1_T1w.png').as_posix()
-             find = '<td><img src="'+path_to_img+'" /></td>'
-             replace = '<td bgcolor="#FF0000" id="biggest"><img src="'+path_to_img+'"/></td>'
-             html_string=html_string.replace(find,replace)
-             f.close()
-         with open(row[1].link, mode='w') as corrected_html_file:
-             corrected_html_file.write(html_string)
-             corrected_html_file.close()
-             
-def create_dataframe_scanner_short(scanner):
+def create_dataframe_scanner_short(scanner, store=None): #writes full_data_short.csv: the largest deviation of any coil per session and the drift alerts of the coils
      df_full=pd.read_csv(default_path.joinpath('sub-'+scanner+'/full_data.csv'),index_col=0)
-     df_median = df_full.rolling(5).median()
-     df_dist = (df_full-df_median)**2
-     df_short = pd.DataFrame(columns=['max_dev', 'max_prop_dev','coil'],index=df_dist.index)
-     coils = ["%.2d" % i for i in range(1,33)]
-     for index, row in df_dist.iterrows():
-         max_dev_coils = 0
-         max_prop_coils = 0
-         max_coil='01'
-         for coil in coils:
-             max_dev = math.sqrt(row['center_of_mass_x_C'+coil]+row['center_of_mass_y_C'+coil]+row['center_of_mass_z_C'+coil])
-             max_prop= math.sqrt(row['signal_proportion_C'+coil])*100
-             if max_dev >= max_dev_coils:
-                 max_dev_coils=max_dev
-                 max_coil=coil
-             if max_prop >= max_prop_coils:
-                 max_prop_coils=max_prop
-         df_short.loc[index,'max_dev']=max_dev_coils
-         df_short.loc[index,'max_prop_dev']=max_prop_coils
-         df_short.loc[index,'coil']=max_coil
+     data = coil_array(df_full) # dates x coils x features
+     dist = (data-rolling_median(data, 5))**2
+     max_dev = np.sqrt(dist[:,:,:3].sum(axis=2)) # dates x coils, NaN if a coil is missing in the window
+     max_prop = np.sqrt(dist[:,:,3])*100
+     max_dev_coils, max_coil = last_max(max_dev)
+     max_prop_coils, _ = last_max(max_prop)
+     df_short = pd.DataFrame({'max_dev': max_dev_coils, 'max_prop_dev': max_prop_coils,
+                              'coil': np.array(coils)[max_coil]}, index=df_full.index)
      df_short=df_short.drop(df_short.index[0:4])
+     metrics_store = store or get_metrics_store()
+     alerts = alert_columns(metrics_store, scanner, 'T1', {'max_dev_alert': lambda series: series.startswith('center_of_mass'),
+                                                           'max_prop_dev_alert': lambda series: series.startswith('signal_proportion')})
+     if store is None:
+         metrics_store.close()
+     df_short = df_short.join(alerts)
+     df_short[alerts.columns] = df_short[alerts.columns].fillna('')
      df_short.index.names = ['date']
-     df_short.to_csv(default_path.joinpath('sub-'+scanner+'/full_data_short.csv'))
+     with traced('table_write', default_path.joinpath('sub-'+scanner+'/full_data_short.csv')):
+         df_short.to_csv(default_path.joinpath('sub-'+scanner+'/full_data_short.csv'))
 
        
 
 if __name__ == "__main__":
 
-    scanners=['Skyra','Prismafit','Prisma']
-    for scanner in scanners:
+    ap = argparse.ArgumentParser(description='Preprocessing of the GRE coil check phantom measurements')
+    ap.add_argument("-s", "--scanners", nargs='+', default=['Skyra','Prismafit','Prisma'], help="scanners to process")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes for the files and reports")
+    ap.add_argument("--render", choices=render_modes, default='inline',
+                    help="render the coil images with the reports (inline), in a pool at the end of the run (deferred) or when first needed (lazy)")
+    ap.add_argument("--dpi", type=int, default=None, help="resolution of the coil images")
+    ap.add_argument("--thumbnails", choices=['nilearn', 'fast'], default='nilearn',
+                    help="plot the coil images with nilearn, or write slice-only tiles and a montage per session (fast)")
+    ap.add_argument("--mirror", default=None, help="local directory for uncompressed, memory-mapped copies of the NIfTI files")
+    ap.add_argument("--mirror-size", type=float, default=50, help="size limit of the mirror in GB")
+    ap.add_argument("--trace", default=None,
+                    help="record time, CPU, bytes read and peak memory per stage and file in this file (JSON lines, or a Chrome trace if it ends with .json)")
+    args = ap.parse_args()
+    if args.mirror is not None:
+        enable_mirror(args.mirror, args.mirror_size)
+    if args.trace is not None:
+        start_trace(args.trace)
+    renderer = RenderQueue(default_path.joinpath('render_queue'), args.render, args.dpi, args.thumbnails)
+
+    for scanner in args.scanners:
         print(scanner)
-        update_all_individual_reports(scanner)
-        update_dataframe_scanner(scanner)
+        update_all_individual_reports(scanner, args.jobs, renderer)
+        update_dataframe_scanner(scanner, args.jobs)
         create_dataframe_scanner_short(scanner)
-        add_marks_worst_coil(scanner)
+        write_coil_reports(scanner)
+    if args.render == 'deferred':
+        renderer.render_pending(args.jobs)
@@ -5,26 +5,35 @@ Spyder Editor
 This is a temporary script file.
 """
 import numpy as np
+import argparse
+import warnings
 import json
 import fsspec
-import re
 from scipy import ndimage
-from scipy.spatial.distance import cdist
-import matplotlib.pyplot as plt
 import glob
 from os import path
-import dateutil.parser as dparser
 import datetime
 import pandas as pd
-from nilearn.plotting import plot_anat
 import nibabel as nib
-import nipype.algorithms.confounds as confounds
-from nilearn.image import new_img_like
 from pathlib import Path
+from functools import partial
+from helpers import parallel_map
+from metric_cache import MetricCache
+from metrics_store import MetricsStore, session_fingerprint
+from nifti_mirror import enable as enable_mirror, load_nifti
+from phantom_render import RenderQueue, render_modes
+from phantom_trace import start as start_trace, traced
+from session_index import get_index, lookup, parse_date
+from phantom_drift import alert_columns, update_drift
+from phantom_metrics import centers_of_mass, max_pairwise_distance, roi_timeseries, stream_run_statistics, tsnr_from_moments, tsnr_maps, weisskoff
 
 pd.set_option('display.max_colwidth', 1000)
 
 default_path = Path('/project/3055010.02/BIDS_data')
+metric_names = ['tSNR','GSR','ref_amp','max_displacement','RDC']
+weisskoff_widths = range(1, 21) # ROI widths (voxels) of the Weisskoff analysis, up to the 20 voxels of the fixed ROI
+metrics_version = 2 # increase when the metric computation changes, this invalidates the metric cache
+derived_maps = 6 # float64 volumes that create_functional_image_metrics derives at once from the statistics of a streamed run (tSNR, masks, GSR), kept free in max_memory
 
 #def create_tSNR_detrend_images(file) : #creates the tSNRimages of detrended images
 #    tsnr = confounds.TSNR(regress_poly=1,
@@ -81,238 +90,210 @@ def gsr(epi_data, mask, axis=1, ref_file=None, out_file=None):
     return float(ghost / signal)
 
 
-def create_functional_image_metrics(filePath) : #creates the tSNRimages of original images
+def save_tsnr_maps(signal_img, file, **maps): #writes the given maps (tsnr, mean, stddev) next to the bold file
+    for suffix, map_data in maps.items():
+        map_img = nib.Nifti1Image(map_data.astype(np.float32), signal_img.affine, signal_img.header)
+        map_img.set_data_dtype(np.float32)
+        nib.save(map_img, file.replace("echo-1_bold","echo-1_bold_"+suffix))
+
+
+def compute_run_statistics(signal_img, streaming=False, chunk_size=16, precision=np.float64, max_memory=None, file=None):
+    # returns the tSNR, mean and stddev maps, the center of mass of every volume and the data to take the ROI from,
+    # either from the full array in memory or (streaming, within max_memory bytes) chunk by chunk from the array proxy
+    # (file names the run in the trace)
+    if max_memory is not None and not streaming:
+        raise ValueError('max_memory only applies to streaming, the whole run is loaded otherwise')
+    if streaming: # loading, tSNR and centroids in one pass
+        reserved = derived_maps * int(np.prod(signal_img.shape[:3])) * 8 # for the maps derived from the statistics
+        with traced('tsnr', file, streaming=True):
+            mean_data, stddev_data, volume_coms = stream_run_statistics(signal_img.dataobj, chunk_size, precision, max_memory, reserved)
+            return tsnr_from_moments(mean_data, stddev_data), mean_data, stddev_data, volume_coms, signal_img.dataobj
+    with traced('load', file):
+        signal_data = signal_img.get_fdata(dtype=precision)
+    with traced('tsnr', file):
+        tsnr_data, mean_data, stddev_data = tsnr_maps(signal_data)
+    with traced('centroids', file):
+        volume_coms = centers_of_mass(signal_data)
+    return tsnr_data, mean_data, stddev_data, volume_coms, signal_data
+
+
+def create_functional_image_metrics(filePath, save_maps=False, renderer=None, **stats_options) : #computes the tSNR maps in memory and the metrics based on them
     file = filePath.as_posix()
-    tsnr = confounds.TSNR(tsnr_file=file.replace("echo-1_bold","echo-1_bold_tsnr"),
-                          mean_file=file.replace("echo-1_bold","echo-1_bold_mean"),
-                          stddev_file=file.replace("echo-1_bold","echo-1_bold_stddev"))
-    tsnr.inputs.in_file = file
-    tsnr.run()
-    tsnr_img = nib.load(file.replace("echo-1_bold","echo-1_bold_tsnr")) #reads tSNR file
-    mean_img = nib.load(file.replace("echo-1_bold","echo-1_bold_mean")) #reads mean file
-    signal_img = nib.load(file) #reads bold file
-    tsnr_data = tsnr_img.get_fdata()
-    mean_data = mean_img.get_fdata()
-    signal_data = signal_img.get_fdata()
+    renderer = renderer or RenderQueue()
+    with traced('open', file): # decompresses the file into the mirror, if enabled and not there yet
+        signal_img = load_nifti(file, keep_file_open=stats_options.get('streaming', False)) #reads bold file (only once), streamed volumes share one open file
+    tsnr_data, mean_data, stddev_data, volume_coms, signal_data = compute_run_statistics(signal_img, file=file, **stats_options)
+    with traced('save_maps', file):
+        if save_maps: # the maps are not needed further on, so writing them is optional
+            save_tsnr_maps(signal_img, file, tsnr=tsnr_data, mean=mean_data, stddev=stddev_data)
+        elif renderer.mode != 'inline': # a queued tSNR plot reads the map from disk
+            save_tsnr_maps(signal_img, file, tsnr=tsnr_data)
     center_of_mass = ndimage.measurements.center_of_mass(tsnr_data)
     x_coord = int(round(center_of_mass[0]))
     y_coord = int(round(center_of_mass[1]))
     z_coord = int(round(center_of_mass[2]))
+    signal_roi = (slice(x_coord-10,x_coord+10),slice(y_coord-10,y_coord+10),slice(z_coord-5,z_coord+5))
     signal_mask =  0*tsnr_data
     mean_data_mask = np.where(mean_data>np.amax(mean_data)*.25, 1, 0) 
-    signal_mask[x_coord-10:x_coord+10,y_coord-10:y_coord+10,z_coord-5:z_coord+5]=1
+    signal_mask[signal_roi]=1
     tsnr_masked_data = tsnr_data*signal_mask
-    signal_mask4d=np.zeros((signal_data.shape[0],signal_data.shape[1],signal_data.shape[2],signal_data.shape[3]))
-    signal_mask4d[:,:,:,:] = signal_mask[:,:,:,np.newaxis] == 1
-    signal_masked_data = signal_data*signal_mask4d
-    timeseries = np.zeros(signal_masked_data.shape[3])
-    center_of_mass_list = list()
-    for i in np.arange(signal_masked_data.shape[3]):
-           timepoint = signal_masked_data[:,:,:,i][signal_masked_data[:,:,:,i]!=0].mean()
-           center_of_mass = ndimage.measurements.center_of_mass(signal_data[:,:,:,i])
-           center_of_mass_list.append(np.asarray([center_of_mass[0],center_of_mass[1],center_of_mass[2]]))
-           timeseries[i]=timepoint
-    hdist = cdist(center_of_mass_list, center_of_mass_list, metric='euclidean')
-    max_displacement = hdist.max()
+    with traced('timeseries', file):
+        timeseries = roi_timeseries(signal_data, signal_roi) # reads only the ROI box, not a masked copy of the run
+    max_displacement = max_pairwise_distance(volume_coms) # all volume centroids at once
     
-    timeseries_poly = np.polyfit(np.arange(signal_masked_data.shape[3]), timeseries, 2)
-    timeseries_fit=np.polyval(timeseries_poly,np.arange(signal_masked_data.shape[3]))
-    fig = plt.figure(figsize=(10, 10))
-    ax = fig.add_subplot(1, 1, 1)
-    ax.set_title('fMRI timeseries and polynomial fit',fontsize=20)
-    ax.set_xlim([0,300])
-    ax.set_xlabel('Time (in TRs)',fontsize=20)
-    ax.set_ylabel('Intensity',fontsize=20)
-    line1 = ax.plot(timeseries,label='Timeseries in mask')    
-    line2 = ax.plot(timeseries_fit,label='Polynomial fit')    
-    ax.legend(fontsize = 'large')
+    timeseries_poly = np.polyfit(np.arange(len(timeseries)), timeseries, 2)
+    timeseries_fit=np.polyval(timeseries_poly,np.arange(len(timeseries)))
+    try: # fluctuation against ROI width around the same center, the largest ROI as wide as the fixed one
+        with traced('weisskoff', file):
+            widths, fluctuations, rdc = weisskoff(signal_data, (x_coord, y_coord, z_coord), weisskoff_widths)
+        renderer.submit('weisskoff', file.replace("echo-1_bold.nii.gz","echo-1_bold_weisskoff.png"),
+                        widths=widths.tolist(), fluctuations=fluctuations.tolist(), rdc=float(rdc))
+    except ValueError as e:
+        warnings.warn('No Weisskoff analysis for %s: %s' % (file, e))
+        rdc = np.nan
     print(file)
-    fig.savefig(file.replace("echo-1_bold.nii.gz","echo-1_bold_timeseries.png"), dpi=500,bbox_inches = 'tight')
-    plt.close(fig)
-    tsnr_mask_img = new_img_like(tsnr_img, tsnr_masked_data)
-    display = plot_anat(tsnr_img,draw_cross=False)
-    display.add_contours(tsnr_mask_img, contours=1, antialiased=False,
-                     linewidths=1., levels=[0], colors=['red'])
-    display.savefig(file.replace("echo-1_bold.nii.gz","echo-1_bold_tsnr.png"))
-    display.close()
+    renderer.submit('timeseries', file.replace("echo-1_bold.nii.gz","echo-1_bold_timeseries.png"),
+                    timeseries=timeseries.tolist(), fit=timeseries_fit.tolist())
+    renderer.submit('tsnr', file.replace("echo-1_bold.nii.gz","echo-1_bold_tsnr.png"),
+                    tsnr_img=nib.Nifti1Image(tsnr_data, signal_img.affine) if renderer.mode == 'inline' else file.replace("echo-1_bold","echo-1_bold_tsnr"),
+                    roi=[[roi_slice.start, roi_slice.stop] for roi_slice in signal_roi])
     tSNR = tsnr_masked_data[np.nonzero(tsnr_masked_data)].mean()
-    ghost_signal_ratio = gsr(mean_data,mean_data_mask)*100
+    with traced('gsr', file):
+        ghost_signal_ratio = gsr(mean_data,mean_data_mask)*100
     json_file=file.replace("echo-1_bold.nii.gz","echo-1_bold.json")
     parsed_json=json_read(json_file)
     ref_amp = parsed_json['TxRefAmp']
-    return  tSNR,ghost_signal_ratio,ref_amp,max_displacement
+    return  tSNR,ghost_signal_ratio,ref_amp,max_displacement,rdc
     
 def get_all_files_scanner(scanner): #gets all files from a specific scanner
-    files = list()
-    for filename in default_path.joinpath('sub-'+scanner).glob('**/func/*'+'ep2dboldstability_run-1_echo-1_bold.nii.gz'):
-        # print(filename)
-        files.append(filename)
-    return files
+    with traced('discovery', scanner=scanner, modality='fMRI'):
+        return [f for f, entry in get_index(default_path, scanner).select(datatype='func', suffix='bold', run='1', echo='1') if is_stability_run(entry)]
+
+def is_stability_run(entry): #the fMRI stability runs (the task label ends with ep2dboldstability)
+    return entry['task'] is not None and entry['task'].endswith('ep2dboldstability')
 
 def json_read(filename):
    with open(filename) as f_in:
        return(json.load(f_in))
 
-def filter_file_list_scanner_after(scanner,date): #gets all files from a specific scanner on a specific date
-    files=get_all_files_scanner(scanner)
-    files_filtered = list()
-    for file in files:
-        match_date = re.search(r'\d{8}_task', file.as_posix())
-        match_date = dparser.parse(match_date.group(0),fuzzy=True)
-        if match_date>datetime.datetime.strptime(str(date), '%Y%m%d'):
-            files_filtered.append(file)
-    return files_filtered
-
-def filter_file_list_scanner_before(scanner,date): #gets all files from a specific scanner on a specific date
-    files=get_all_files_scanner(scanner)
-    files_filtered = list()
-    for file in files:
-        match_date = re.search(r'\d{8}_task', file.as_posix())
-        match_date = dparser.parse(match_date.group(0),fuzzy=True)
-        if match_date<datetime.datetime.strptime(str(date), '%Y%m%d'):
-            files_filtered.append(file)
-    return files_filtered
+def get_session_files(scanner): #gets the files of a scanner grouped by session date (YYYYMMDD)
+    files = get_all_files_scanner(scanner)
+    sessions = dict()
+    for file, date in zip(files, get_date_from_file_list(files)):
+        sessions.setdefault(datetime.date.strftime(date,'%Y%m%d'), list()).append(file)
+    return sessions
  
 def get_date_from_file_list(files):
-    dates=list()
-    for file in files:
-        match_date = re.search(r'\d{8}_task', file.as_posix())
-        match_date = dparser.parse(match_date.group(0),fuzzy=True)
-        dates.append(match_date.date())
-    return dates
+    return [parse_date(lookup(default_path, file)['date']) for file in files]
 
 
-def create_dataframe_scanner(scanner):
-    files = get_all_files_scanner(scanner)
-    file_dates = get_date_from_file_list(files)
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    col_names = ['tSNR','GSR','ref_amp','max_displacement']
-    df = pd.DataFrame(columns=col_names,index=dates_df)
-    i=0
-    for file in files:
-        if not path.exists(file.replace("echo-1_bold.nii.gz","echo-1_bold_timeseries.png")):
-            tSNR,GSR,ref_amp,max_displacement = create_functional_image_metrics(file)
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'tSNR']=tSNR
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'GSR']=GSR
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'ref_amp']=ref_amp
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'max_displacement']=max_displacement
-
-        else:
-            tsnr_img = nib.load(file.replace("echo-1_bold","echo-1_bold_tsnr")) #reads tSNR file
-            mean_img = nib.load(file.replace("echo-1_bold","echo-1_bold_mean")) #reads tSNR file
-            signal_img = nib.load(file)
-            signal_data = signal_img.get_fdata()
-            center_of_mass_list = list()
-            for image in np.arange(signal_img.shape[3]):
-                center_of_mass = ndimage.measurements.center_of_mass(signal_data[:,:,:,image])
-                center_of_mass_list.append(np.asarray([center_of_mass[0],center_of_mass[1],center_of_mass[2]]))
-            hdist = cdist(center_of_mass_list, center_of_mass_list, metric='euclidean')
-            max_displacement = hdist.max()
-            tsnr_data = tsnr_img.get_fdata()
-            mean_data = mean_img.get_fdata()
-            center_of_mass = ndimage.measurements.center_of_mass(tsnr_data)
-            x_coord = int(round(center_of_mass[0]))
-            y_coord = int(round(center_of_mass[1]))
-            z_coord = int(round(center_of_mass[2]))
-            signal_mask =  0*tsnr_data
-            mean_data_mask = np.where(mean_data>np.amax(mean_data)*.25, 1, 0) 
-            signal_mask[x_coord-10:x_coord+10,y_coord-10:y_coord+10,z_coord-5:z_coord+5]=1
-            tsnr_masked_data = tsnr_data*signal_mask
-            tSNR = tsnr_masked_data[np.nonzero(tsnr_masked_data)].mean()
-            GSR = gsr(mean_data,mean_data_mask)*100
-            json_file=file.replace("echo-1_bold.nii.gz","echo-1_bold.json")
-            parsed_json=json_read(json_file)
-            ref_amp = parsed_json['TxRefAmp']
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'tSNR']=tSNR
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'GSR']=GSR
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'ref_amp']=ref_amp
-            df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'max_displacement']=max_displacement
-        i=i+1
-    df=df.sort_index()
+def get_metric_cache(scanner): #the cache with the metrics of all fMRI files of a scanner
+    return MetricCache(default_path.joinpath('sub-'+scanner+'/metric_cache_fMRI.json'), metrics_version)
+
+
+def compute_missing_metrics(files, cache, jobs=1, save_maps=False, renderer=None, **stats_options): #computes the metrics of new or changed files only (in parallel with jobs>1) and stores them in the cache
+    missing = [file for file in files if cache.get(file) is None]
+    results = parallel_map(partial(create_functional_image_metrics, save_maps=save_maps, renderer=renderer, **stats_options), missing, jobs)
+    for file, result in zip(missing, results): # results come back in the order of the files
+        cache.put(file, dict(zip(metric_names, result)))
+    cache.save()
+
+
+def get_metrics_store(): #the store with the metrics of all scanners and sessions
+    return MetricsStore(default_path.joinpath('phantom_metrics.db'))
+
+
+def export_full_data(scanner, store): #updates the drift statistics and writes full_data_fMRI.csv (one row per session, one column per metric and its drift alerts) from the store
+    df = store.wide(scanner, 'fMRI').reindex(columns=metric_names)
+    with traced('drift', scanner=scanner, modality='fMRI'):
+        update_drift(store, scanner, 'fMRI', df) # only the sessions after the stored drift state
+    alerts = alert_columns(store, scanner, 'fMRI', {name+'_alert': lambda series, name=name: series == name for name in metric_names})
+    df = df.join(alerts)
+    df[alerts.columns] = df[alerts.columns].fillna('')
     df.index.names = ['date']
-    df.to_csv(default_path.joinpath('sub-'+scanner+'/full_data_fMRI.csv'))
-
-
-def update_dataframe_scanner(scanner):
-    full_data_path = default_path.joinpath('sub-'+scanner).joinpath('full_data_fMRI.csv')
-    df_full=pd.read_csv(full_data_path, index_col=0)
-    first_date = df_full.index[0]
-    files_before=filter_file_list_scanner_before(scanner,first_date)
-    last_date = df_full.index[-1]
-    files_after=filter_file_list_scanner_after(scanner,last_date)
-    files=files_before+files_after
-    file_dates = get_date_from_file_list(files)
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    col_names = ['tSNR','GSR','ref_amp']
-    df = pd.DataFrame(columns=col_names,index=dates_df)
-    i=0
-    for file in files:
-        tSNR,GSR,ref_amp,max_displacement = create_functional_image_metrics(file)
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'tSNR']=tSNR
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'GSR']=GSR
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'ref_amp']=ref_amp
-        df.loc[datetime.date.strftime(file_dates[i],'%Y%m%d'),'max_displacement']=max_displacement
-
-        i=i+1
-    df.index=pd.Index.astype(df.index,'int')
-    df_full=df_full.append(df)
-    df_full=df_full.sort_index()
-    df_full.index.names = ['date']
-    df_full.to_csv(full_data_path)
+    with traced('table_write', default_path.joinpath('sub-'+scanner+'/full_data_fMRI.csv')):
+        df.to_csv(default_path.joinpath('sub-'+scanner+'/full_data_fMRI.csv'))
+
+
+def create_dataframe_scanner(scanner, jobs=1, save_maps=False, renderer=None, **stats_options): #stores the metrics of all sessions again (the metric cache still applies)
+    store = get_metrics_store()
+    store.clear(scanner, 'fMRI')
+    store.close()
+    update_dataframe_scanner(scanner, jobs, save_maps, renderer, **stats_options)
+
+
+def update_dataframe_scanner(scanner, jobs=1, save_maps=False, renderer=None, **stats_options): #processes the sessions that are new or have other files than when they were stored, wherever they are in the history
+    session_files = get_session_files(scanner)
+    store = get_metrics_store()
+    new_sessions = {date: session_files[date] for date in store.new_sessions(scanner, 'fMRI', session_files)}
+    store_sessions(scanner, store, new_sessions, get_metric_cache(scanner), jobs, save_maps, renderer, **stats_options)
+    export_full_data(scanner, store)
+    store.close()
+
+
+def store_sessions(scanner, store, session_files, cache, jobs=1, save_maps=False, renderer=None, **stats_options): #computes the metrics of some sessions (dict of date to files) and writes them to the store
+    compute_missing_metrics([file for files in session_files.values() for file in files], cache, jobs, save_maps, renderer, **stats_options)
+    rows = [(date, '', name, cache.get(file)[name]) for date, files in session_files.items() for file in files for name in metric_names]
+    with traced('store_write', store.db_file, scanner=scanner, modality='fMRI', sessions=len(session_files)):
+        store.write_sessions(scanner, 'fMRI', rows, {date: session_fingerprint(files) for date, files in session_files.items()})
     
 def create_report(scanner,date):
     f = open(default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'_phantom_fMRI.html'),'w')
     source = default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'/func/sub-'+scanner+'_ses-'+str(date)+'_task-ep2dboldstability_run-1_echo-1_bold_tsnr.png')
     source2 = default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'/func/sub-'+scanner+'_ses-'+str(date)+'_task-ep2dboldstability_run-1_echo-1_bold_timeseries.png')
+    source3 = default_path.joinpath('sub-'+scanner+'/ses-'+str(date)+'/func/sub-'+scanner+'_ses-'+str(date)+'_task-ep2dboldstability_run-1_echo-1_bold_weisskoff.png')
     message = """<html>
     <head></head>
-    <body><img src="%(source)s"><br><img src="%(source2)s" height="550" width="550"></body>
-    </html>""" % {'source': source,'source2': source2}
+    <body><img src="%(source)s"><br><img src="%(source2)s" height="550" width="550"><img src="%(source3)s" height="550" width="550"></body>
+    </html>""" % {'source': source,'source2': source2,'source3': source3}
     f.write(message)
     f.close()
 
-def create_all_individual_reports(scanner):
-    files= get_all_files_scanner(scanner)
-    file_dates = get_date_from_file_list(files) 
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    dates_df = list(map(int, dates_df))
-    for dates in dates_df:
-        print (str(dates))
-        create_report(scanner,dates)
+def create_all_individual_reports(scanner, jobs=1):
+    dates_df = list(map(int, sorted(get_session_files(scanner))))
+    print (', '.join(map(str, dates_df)))
+    parallel_map(partial(create_report, scanner), dates_df, jobs)
         
-def update_all_individual_reports(scanner):
-    df_full=pd.read_csv(default_path.joinpath('sub-'+scanner).joinpath('full_data_fMRI.csv'),index_col=0)
-
-    first_date = df_full.index[0]
-    files_before=filter_file_list_scanner_before(scanner,first_date)
-    last_date = df_full.index[-1]
-    files_after=filter_file_list_scanner_after(scanner,last_date)
-    files=files_before+files_after
-    file_dates = get_date_from_file_list(files) 
-    dates_df = sorted(file_dates) #sort dates
-    dates_df = set(dates_df) #remove duplicates
-    dates_df = list(dates_df) #puts in list format
-    dates_df = [datetime.date.strftime(x,'%Y%m%d') for x in dates_df] #puts dates in string format
-    dates_df = list(map(int, dates_df))
-    for dates in dates_df:
-        print (str(dates))
-        create_report(scanner,dates)
+def update_all_individual_reports(scanner, jobs=1): #writes the reports of the sessions that are not in the store yet (run before update_dataframe_scanner)
+    session_files = get_session_files(scanner)
+    store = get_metrics_store()
+    dates_df = list(map(int, store.new_sessions(scanner, 'fMRI', session_files)))
+    store.close()
+    print (', '.join(map(str, dates_df)))
+    parallel_map(partial(create_report, scanner), dates_df, jobs)
 
-        
 if __name__ == "__main__":
 
-    scanners=['Skyra','Prismafit','Prisma']
-    for scanner in scanners:
+    ap = argparse.ArgumentParser(description='Preprocessing of the fMRI phantom measurements')
+    ap.add_argument("-s", "--scanners", nargs='+', default=['Skyra','Prismafit','Prisma'], help="scanners to process")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes for the files and reports")
+    ap.add_argument("--save-maps", action='store_true', help="also write the tSNR, mean and stddev maps as NIfTI files")
+    ap.add_argument("--streaming", action='store_true', help="read the runs in chunks instead of loading them in memory")
+    ap.add_argument("--chunk-size", type=int, default=16, help="volumes per chunk in streaming mode")
+    ap.add_argument("--precision", choices=['float32','float64'], default='float64', help="float type of the computations")
+    ap.add_argument("--max-memory", type=float, default=None, help="memory ceiling per run in MB in streaming mode")
+    ap.add_argument("--render", choices=render_modes, default='inline',
+                    help="render the figures with the metrics (inline), in a pool at the end of the run (deferred) or when first needed (lazy)")
+    ap.add_argument("--dpi", type=int, default=None, help="resolution of the figures")
+    ap.add_argument("--mirror", default=None, help="local directory for uncompressed, memory-mapped copies of the NIfTI files")
+    ap.add_argument("--mirror-size", type=float, default=50, help="size limit of the mirror in GB")
+    ap.add_argument("--trace", default=None,
+                    help="record time, CPU, bytes read and peak memory per stage and file in this file (JSON lines, or a Chrome trace if it ends with .json)")
+    args = ap.parse_args()
+    if args.max_memory is not None and not args.streaming:
+        ap.error('--max-memory only applies with --streaming, the whole run is loaded otherwise')
+    if args.mirror is not None:
+        enable_mirror(args.mirror, args.mirror_size)
+    if args.trace is not None:
+        start_trace(args.trace)
+    stats_options = {'streaming': args.streaming, 'chunk_size': args.chunk_size, 'precision': np.dtype(args.precision).type,
+                     'max_memory': None if args.max_memory is None else args.max_memory*2**20}
+
+    renderer = RenderQueue(default_path.joinpath('render_queue'), args.render, args.dpi)
+
+    for scanner in args.scanners:
         print(scanner)
-        update_all_individual_reports(scanner)
-        update_dataframe_scanner(scanner)
-
+        update_all_individual_reports(scanner, args.jobs)
+        update_dataframe_scanner(scanner, args.jobs, args.save_maps, renderer, **stats_options)
+    if args.render == 'deferred':
+        renderer.render_pending(args.jobs)
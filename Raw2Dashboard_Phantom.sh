@@ -4,11 +4,10 @@
 
 cd /project/3055010.02/QualityAssessment_2022/
 source ./venv/bin/activate venv
-sh Raw2Bids_Phantom.sh
-cd /project/3055010.02/QualityAssessment_2022/
-python Preprocess_Phantom_T1.py
-python Preprocess_Phantom_fMRI.py
-python Dashboard_Phantom.py
+# the pipeline runs the BIDS conversion (Raw2Bids_Phantom.sh), the preprocessing of the new sessions and the dashboard;
+# stages whose inputs did not change since the last run are skipped (add --force to run everything);
+# the dashboard keeps its port, a dashboard that runs there from an earlier night shows the new data
+python Pipeline_Phantom.py --convert --dashboard --port 8050
 
 
 
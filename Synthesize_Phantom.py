@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Writes a synthetic BIDS tree with phantom measurements (GRE coil checks and fMRI stability runs),
+# to test and benchmark the preprocessing without the real data
+
+import argparse
+import datetime
+import hashlib
+import json
+from functools import partial
+from pathlib import Path
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+from helpers import parallel_map
+
+coils = ["%.2d" % i for i in range(1,33)] #coil list
+generator_name = 'Synthesize_Phantom.py' # recorded in dataset_description.json, Benchmark_Phantom.py checks for it
+
+
+def session_rng(seed, scanner, date): # the random numbers of a session don't depend on the other sessions
+    return np.random.default_rng([seed, int(hashlib.sha1(('%s/%s' % (scanner, date)).encode()).hexdigest()[:8], 16)])
+
+
+def phantom_mask(shape, center=None, radius=0.35):
+    """ Returns a boolean ellipsoid (the phantom) with semi-axes of radius times the matrix size, around center (voxels)."""
+    center = [(n - 1) / 2 for n in shape] if center is None else center
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    return sum(((grid - c) / (radius * n)) ** 2 for grid, c, n in zip(grids, center, shape)) <= 1
+
+
+def coil_positions():
+    """ Returns the positions of the 32 coils (4 rings of 8 around the z axis) in coordinates relative to the matrix."""
+    angles = 2 * np.pi * np.arange(8) / 8
+    return np.array([(0.5 + 0.6 * np.cos(angle), 0.5 + 0.6 * np.sin(angle), 0.5 + z)
+                     for z in (-0.3, -0.1, 0.1, 0.3) for angle in angles])
+
+
+def coil_check_images(shape, rng, faulty_rate=0.0, noise=5.0):
+    """ Simulates the 32 single coil GRE images of a session.
+
+    Each coil sees the phantom through an exponentially decaying sensitivity. The phantom position is jittered
+    per session, the coil gains vary slightly and a coil is faulty (low gain) with probability faulty_rate.
+
+    Returns:
+        images : list of 32 int16 arrays
+    """
+    center = np.array([(n - 1) / 2 for n in shape]) + rng.normal(0, 0.3, 3)
+    mask = phantom_mask(shape, center)
+    coordinates = np.stack(np.meshgrid(*[np.arange(n) / n for n in shape], indexing='ij'), axis=-1)
+    images = list()
+    for position in coil_positions():
+        gain = rng.normal(1, 0.02) * (0.3 if rng.random() < faulty_rate else 1)
+        sensitivity = gain * np.exp(-np.linalg.norm(coordinates - position, axis=-1) / 0.35)
+        signal = 1000 * mask * sensitivity
+        magnitude = np.abs(signal + rng.normal(0, noise, shape) + 1j * rng.normal(0, noise, shape)) # Rician background
+        images.append(np.round(magnitude).astype(np.int16))
+    return images
+
+
+def stability_run(shape, volumes, rng, drift=0.01, ghost=0.03, motion=0.05, fluctuation=0.001, noise=5.0):
+    """ Simulates an fMRI stability run of the phantom.
+
+    Parameters:
+        shape : the matrix of a volume
+        volumes : the number of volumes
+        drift : relative signal change over the run (linear and quadratic)
+        ghost : relative amplitude of the Nyquist ghost (shifted by half the matrix along the phase encoding axis, y)
+        motion : maximum displacement of the phantom in voxels (random walk)
+        fluctuation : relative global signal fluctuation per volume (spatially correlated noise)
+        noise : standard deviation of the thermal noise
+
+    Returns:
+        data : int16 array (x, y, z, volumes)
+    """
+    base = 1000 * ndimage.gaussian_filter(phantom_mask(shape).astype(float), 0.7)
+    t = np.arange(volumes) / volumes
+    scale = 1 + drift * (t + t ** 2) / 2 + rng.normal(0, fluctuation, volumes)
+    walk = np.cumsum(rng.normal(0, 1, (volumes, 3)), axis=0)
+    shifts = motion * walk / max(np.abs(walk).max(), 1e-9)
+    data = np.empty(tuple(shape) + (volumes,), np.int16)
+    for volume in range(volumes):
+        image = ndimage.shift(base, shifts[volume], order=1) * scale[volume]
+        image = image + ghost * np.roll(image, shape[1] // 2, axis=1)
+        data[..., volume] = np.round(np.abs(image + rng.normal(0, noise, shape)))
+    return data
+
+
+def save_image(data, file, voxel_size):
+    img = nib.Nifti1Image(data, np.diag(list(voxel_size) + [1]))
+    img.header.set_xyzt_units('mm', 'sec')
+    nib.save(img, file)
+
+
+def write_session(output, scanner, date, seed=0, coil_matrix=(64,64,32), fmri_matrix=(64,64,32), volumes=300,
+                  faulty_rate=0.05, coil_naming='C', t1=True, fmri=True, overwrite=False):
+    """ Writes the coil check and fMRI stability files of one session (existing files are kept unless overwrite)."""
+    rng = session_rng(seed, scanner, date)
+    session = 'sub-%s/ses-%s' % (scanner, date)
+    if t1:
+        anat = Path(output).joinpath(session, 'anat')
+        anat.mkdir(parents=True, exist_ok=True)
+        names = ['sub-%s_ses-%s_acq-grecoilCheck%s_run-1_T1w' % (scanner, date, 'C' + coil if coil_naming == 'C' else 'cH%i' % int(coil))
+                 for coil in coils]
+        if overwrite or not all(anat.joinpath(name + '.nii.gz').exists() for name in names):
+            for name, image in zip(names, coil_check_images(coil_matrix, rng, faulty_rate)):
+                save_image(image, anat.joinpath(name + '.nii.gz'), (4, 4, 4))
+                with open(anat.joinpath(name + '.json'), 'w') as f:
+                    json.dump({'ManufacturersModelName': scanner, 'RepetitionTime': 0.2, 'EchoTime': 0.01}, f)
+    if fmri:
+        func = Path(output).joinpath(session, 'func')
+        func.mkdir(parents=True, exist_ok=True)
+        name = 'sub-%s_ses-%s_task-ep2dboldstability_run-1_echo-1_bold' % (scanner, date)
+        if overwrite or not func.joinpath(name + '.nii.gz').exists():
+            save_image(stability_run(fmri_matrix, volumes, rng), func.joinpath(name + '.nii.gz'), (3.5, 3.5, 3.5))
+            with open(func.joinpath(name + '.json'), 'w') as f:
+                json.dump({'ManufacturersModelName': scanner, 'RepetitionTime': 2.0, 'EchoTime': 0.03,
+                           'TxRefAmp': round(float(250 + 5 * (len(scanner) % 5) + rng.normal(0, 2)), 1)}, f)
+
+
+def session_dates(sessions, start='20220103', interval=7): # weekly sessions by default, YYYYMMDD strings
+    first = datetime.datetime.strptime(start, '%Y%m%d').date()
+    return [(first + datetime.timedelta(days=interval * i)).strftime('%Y%m%d') for i in range(sessions)]
+
+
+def write_scanner_session(output, session_options, session): # write_session for a (scanner, date) pair, to map over the sessions
+    print('%s %s' % session)
+    write_session(output, *session, **session_options)
+
+
+def write_tree(output, scanners, sessions, start='20220103', interval=7, jobs=1, **session_options):
+    """ Writes the sessions of all scanners (in jobs worker processes), dataset_description.json and an events.csv for the dashboard."""
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    with open(output.joinpath('dataset_description.json'), 'w') as f:
+        json.dump({'Name': 'Synthetic phantom QC data', 'BIDSVersion': '1.6.0', 'DatasetType': 'raw',
+                   'GeneratedBy': [{'Name': generator_name}]}, f, indent=1)
+    dates = session_dates(sessions, start, interval)
+    parallel_map(partial(write_scanner_session, output, session_options),
+                 [(scanner, date) for scanner in scanners for date in dates], jobs)
+    first = datetime.datetime.strptime(dates[0], '%Y%m%d')
+    middle = datetime.datetime.strptime(dates[len(dates) // 2], '%Y%m%d')
+    pd.DataFrame({'scanner': [scanners[0], 'Multiple'],
+                  'date_start': [middle.strftime('%d/%m/%Y'), first.strftime('%d/%m/%Y')],
+                  'date_end': [(middle + datetime.timedelta(days=2)).strftime('%d/%m/%Y'), first.strftime('%d/%m/%Y')],
+                  'description': ['Service', 'Start'],
+                  'long_description': ['Synthetic service visit', 'First synthetic session']}).to_csv(output.joinpath('events.csv'), index=False)
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser(description='Writes a synthetic BIDS tree with phantom QC measurements')
+    ap.add_argument("-o", "--output", required=True, help="the BIDS directory to write")
+    ap.add_argument("-s", "--scanners", nargs='+', default=['Skyra','Prismafit','Prisma'], help="scanner names")
+    ap.add_argument("-n", "--sessions", type=int, default=10, help="sessions per scanner")
+    ap.add_argument("--start", default='20220103', help="date of the first session (YYYYMMDD)")
+    ap.add_argument("--interval", type=int, default=7, help="days between sessions")
+    ap.add_argument("--coil-matrix", type=int, nargs=3, default=[64,64,32], help="matrix of the coil check images")
+    ap.add_argument("--fmri-matrix", type=int, nargs=3, default=[64,64,32], help="matrix of the fMRI volumes")
+    ap.add_argument("--volumes", type=int, default=300, help="volumes per fMRI run")
+    ap.add_argument("--faulty-rate", type=float, default=0.05, help="probability that a coil is faulty in a session")
+    ap.add_argument("--coil-naming", choices=['C', 'cH'], default='C', help="acq label of the coil files: grecoilCheckC01 or grecoilCheckcH1")
+    ap.add_argument("--no-t1", action='store_true', help="don't write coil check images")
+    ap.add_argument("--no-fmri", action='store_true', help="don't write fMRI runs")
+    ap.add_argument("--seed", type=int, default=0, help="random seed")
+    ap.add_argument("--overwrite", action='store_true', help="rewrite existing sessions")
+    ap.add_argument("-j", "--jobs", type=int, default=1, help="number of worker processes")
+    args = ap.parse_args()
+
+    write_tree(args.output, args.scanners, args.sessions, args.start, args.interval, args.jobs, seed=args.seed,
+               coil_matrix=tuple(args.coil_matrix), fmri_matrix=tuple(args.fmri_matrix), volumes=args.volumes,
+               faulty_rate=args.faulty_rate, coil_naming=args.coil_naming, t1=not args.no_t1, fmri=not args.no_fmri,
+               overwrite=args.overwrite)
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 
-# Just one function for now
+# helper functions used by the dashboards and the preprocessing scripts
 
+import multiprocessing
 import socket
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import closing
 
 # finds a free port to initialize the app
@@ -11,3 +13,19 @@ def find_free_port():
         s.bind(('', 0))
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         return s.getsockname()[1]
+
+# whether a server listens on the port of this host (e.g. a running dashboard)
+def port_in_use(port):
+    with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
+        return s.connect_ex(('127.0.0.1', int(port))) == 0
+
+# applies func to every item, in a pool of worker processes if jobs > 1
+# the results are always returned in the order of the items, so merging them is deterministic
+# the workers are spawned, not forked: the pipeline calls this from the threads of its stages, and a forked worker
+# could inherit a lock held by another thread and wait forever (the settings of the workers are environment variables)
+def parallel_map(func, items, jobs=1):
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(items)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(func, items))
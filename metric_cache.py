@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# persistent per-file cache for the scalar metrics of the phantom preprocessing scripts
+
+import json
+import os
+from pathlib import Path
+
+
+class MetricCache:
+    """ Stores the scalar metrics computed from each image file in a JSON file.
+
+    An entry is valid as long as the file path, size and modification time and the version of the metric
+    algorithm are the same.
+
+    Parameters:
+        cache_file : the JSON file that holds the cache
+        version : the version of the metric algorithm; increase it to invalidate all entries
+        base_file : another cache file whose entries are used as well, but not written (e.g. the main cache,
+            when a shard of a job array writes its own cache file)
+    """
+
+    def __init__(self, cache_file, version, base_file=None):
+        self.cache_file = Path(cache_file)
+        self.version = version
+        self.entries = dict()
+        for file in [base_file, self.cache_file]:
+            if file is not None and Path(file).exists():
+                with open(file) as f:
+                    self.entries.update(json.load(f))
+        self.changed = False
+
+    def get(self, file):
+        """ Returns the cached metrics (dict) of the file, or None if they have to be recomputed."""
+        entry = self.entries.get(Path(file).as_posix())
+        if entry is None or entry['version'] != self.version:
+            return None
+        stat = os.stat(file)
+        if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return entry['metrics']
+
+    def put(self, file, metrics):
+        """ Stores the metrics (dict of scalars) of the file."""
+        stat = os.stat(file)
+        entry = {'size': stat.st_size,
+                 'mtime_ns': stat.st_mtime_ns,
+                 'version': self.version,
+                 'metrics': {k: float(v) for k, v in metrics.items()}}
+        self.entries[Path(file).as_posix()] = entry
+        self.changed = True
+
+    def update(self, other):
+        """ Adds the entries of another cache (e.g. of a shard), replacing the entries of the same files."""
+        self.entries.update(other.entries)
+        self.changed = True
+
+    def save(self):
+        """ Writes the cache to disk (through a temporary file, so that an interrupted run does not corrupt it)."""
+        if not self.changed:
+            return
+        tmp_file = self.cache_file.with_name(self.cache_file.name + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.cache_file)
+        self.changed = False
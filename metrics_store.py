@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# SQLite store with the phantom metrics of all scanners, updated per session instead of rewriting the tables
+
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+
+schema = '''
+CREATE TABLE IF NOT EXISTS metrics (
+    scanner TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    date TEXT NOT NULL,
+    coil TEXT NOT NULL, -- '' for metrics of the whole session
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (scanner, modality, date, coil, metric)
+);
+CREATE TABLE IF NOT EXISTS sessions (
+    scanner TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    date TEXT NOT NULL,
+    fingerprint TEXT NOT NULL, -- of the image files the metrics were computed from, see session_fingerprint
+    PRIMARY KEY (scanner, modality, date)
+);
+CREATE TABLE IF NOT EXISTS drift (
+    scanner TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    date TEXT NOT NULL,
+    series TEXT NOT NULL, -- the column of the exported table, e.g. tSNR or center_of_mass_x_C05
+    value REAL,
+    center REAL, -- robust baseline and control limits before this session, NULL while the baseline is too short
+    lower REAL,
+    upper REAL,
+    z REAL,
+    cusum_pos REAL,
+    cusum_neg REAL,
+    alert TEXT NOT NULL, -- '' if the session is in control
+    PRIMARY KEY (scanner, modality, series, date)
+);
+CREATE TABLE IF NOT EXISTS drift_state (
+    scanner TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    series TEXT NOT NULL,
+    date TEXT NOT NULL, -- the last session in the state
+    state TEXT NOT NULL, -- JSON, see phantom_drift.DriftTracker
+    PRIMARY KEY (scanner, modality, series)
+);
+'''
+
+
+def session_fingerprint(files):
+    """ Returns the sha1 of the paths, sizes and modification times of the files of a session (the key of the
+    metric cache), so that a replaced or rewritten file changes it as well as an added or removed one."""
+    fingerprint = hashlib.sha1()
+    for file in sorted(Path(file).as_posix() for file in files):
+        stat = os.stat(file)
+        fingerprint.update(('%s\0%i\0%i\n' % (file, stat.st_size, stat.st_mtime_ns)).encode())
+    return fingerprint.hexdigest()
+
+
+class MetricsStore:
+    """ The metrics of the phantom sessions in long format (one row per scanner, modality, date, coil and metric).
+
+    A session is written in one transaction together with the fingerprint of the files it was computed from,
+    so an update only has to process the sessions that are new or whose files were added, removed or changed
+    since (see new_sessions), wherever they are in the history. Writing a session again replaces its rows.
+
+    Parameters:
+        db_file : the SQLite database file, created if it does not exist
+    """
+
+    def __init__(self, db_file):
+        self.db_file = Path(db_file)
+        self.connection = sqlite3.connect(self.db_file, timeout=60) # other stages of the pipeline may be writing
+        with self.connection:
+            self.connection.executescript(schema)
+
+    def processed_sessions(self, scanner, modality):
+        """ Returns the processed sessions as a dict of date (YYYYMMDD string) to the fingerprint of their files."""
+        rows = self.connection.execute('SELECT date, fingerprint FROM sessions WHERE scanner = ? AND modality = ?', (scanner, modality))
+        return dict(rows.fetchall())
+
+    def new_sessions(self, scanner, modality, session_files):
+        """ Returns the dates of session_files (dict of date to list of files) that were not processed with these files yet."""
+        processed = self.processed_sessions(scanner, modality)
+        return sorted(date for date, files in session_files.items() if processed.get(date) != session_fingerprint(files))
+
+    def write_sessions(self, scanner, modality, rows, fingerprints):
+        """ Replaces the metrics of some sessions and marks them as processed.
+
+        Parameters:
+            rows : iterable of (date, coil, metric, value), coil is '' for metrics of the whole session
+            fingerprints : dict of date to the fingerprint of the files of the session (session_fingerprint),
+                the sessions that are replaced
+        """
+        with self.connection: # one transaction, an interrupted update leaves the sessions unprocessed
+            if fingerprints: # the drift statistics are recomputed if a session before their last one changed
+                self._clear_drift(scanner, modality, min(map(str, fingerprints)))
+            self.connection.executemany('DELETE FROM metrics WHERE scanner = ? AND modality = ? AND date = ?',
+                                        [(scanner, modality, date) for date in fingerprints])
+            self.connection.executemany('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(scanner, modality, str(date), coil, metric, float(value)) for date, coil, metric, value in rows])
+            self.connection.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)',
+                                        [(scanner, modality, str(date), fingerprint) for date, fingerprint in fingerprints.items()])
+
+    def clear(self, scanner, modality):
+        """ Removes all metrics and sessions of a scanner and modality, e.g. before recomputing everything."""
+        with self.connection:
+            self.connection.execute('DELETE FROM metrics WHERE scanner = ? AND modality = ?', (scanner, modality))
+            self.connection.execute('DELETE FROM sessions WHERE scanner = ? AND modality = ?', (scanner, modality))
+            self._clear_drift(scanner, modality)
+
+    def frame(self, scanner, modality):
+        """ Returns the metrics of a scanner and modality as a long DataFrame (date, coil, metric, value)."""
+        return pd.read_sql_query('SELECT date, coil, metric, value FROM metrics WHERE scanner = ? AND modality = ?',
+                                 self.connection, params=(scanner, modality))
+
+    def wide(self, scanner, modality):
+        """ Returns the metrics as a wide table: one row per date (int index) and one column per metric,
+        named <metric>_C<coil> for coil metrics."""
+        df = self.frame(scanner, modality)
+        df['column'] = df['metric'].where(df['coil'] == '', df['metric'] + '_C' + df['coil'])
+        df['date'] = df['date'].astype(int)
+        df = df.pivot(index='date', columns='column', values='value').sort_index()
+        df.columns.name = None
+        return df
+
+    def drift_states(self, scanner, modality):
+        """ Returns the drift states of a scanner and modality as a dict of series to (date of the last session, state dict)."""
+        rows = self.connection.execute('SELECT series, date, state FROM drift_state WHERE scanner = ? AND modality = ?', (scanner, modality))
+        return {series: (date, json.loads(state)) for series, date, state in rows.fetchall()}
+
+    def write_drift(self, scanner, modality, rows, states):
+        """ Adds drift results and replaces the drift states, in one transaction.
+
+        Parameters:
+            rows : iterable of (date, series, value, center, lower, upper, z, cusum_pos, cusum_neg, alert)
+            states : dict of series to (date of the last session, state dict)
+        """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO drift VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                        [(scanner, modality, str(date), series) + tuple(None if value != value else value for value in values) + (alert,)
+                                         for date, series, *values, alert in rows])
+            self.connection.executemany('INSERT OR REPLACE INTO drift_state VALUES (?, ?, ?, ?, ?)',
+                                        [(scanner, modality, series, str(date), json.dumps(state)) for series, (date, state) in states.items()])
+
+    def _clear_drift(self, scanner, modality, from_date=None):
+        # removes the drift results and states (within the transaction of the caller); with from_date only if a state
+        # already includes that date, the states can't be rolled back so the whole history is replayed
+        if from_date is not None:
+            latest = self.connection.execute('SELECT MAX(date) FROM drift_state WHERE scanner = ? AND modality = ?', (scanner, modality)).fetchone()[0]
+            if latest is None or latest < from_date:
+                return
+        self.connection.execute('DELETE FROM drift WHERE scanner = ? AND modality = ?', (scanner, modality))
+        self.connection.execute('DELETE FROM drift_state WHERE scanner = ? AND modality = ?', (scanner, modality))
+
+    def drift_frame(self, scanner, modality, alerts_only=False):
+        """ Returns the drift results of a scanner and modality as a long DataFrame (date, series, value, center, lower,
+        upper, z, cusum_pos, cusum_neg, alert), only the sessions with an alert if alerts_only."""
+        return pd.read_sql_query('SELECT date, series, value, center, lower, upper, z, cusum_pos, cusum_neg, alert FROM drift '
+                                 'WHERE scanner = ? AND modality = ?' + (" AND alert != ''" if alerts_only else ''),
+                                 self.connection, params=(scanner, modality))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# local, uncompressed mirror of the gzipped NIfTI files, so that they are decompressed only once
+
+import gzip
+import hashlib
+import os
+import shutil
+import time
+from pathlib import Path
+
+import nibabel as nib
+
+# the mirror is configured through environment variables, so that worker processes use the same mirror
+MIRROR_DIR_VARIABLE = 'PHANTOM_NIFTI_MIRROR'
+MIRROR_SIZE_VARIABLE = 'PHANTOM_NIFTI_MIRROR_SIZE'
+
+
+class NiftiMirror:
+    """ Keeps uncompressed copies of .nii.gz files in a local directory and opens them memory-mapped.
+
+    A copy is named after the source path, size and modification time, so a changed source is mirrored
+    again and its old copy removed. The least recently used copies are removed when the mirror grows
+    beyond max_bytes (copies used in the last minute are kept, another process may be opening them).
+
+    Parameters:
+        mirror_dir : the local directory with the uncompressed copies
+        max_bytes : the size limit of the mirror
+    """
+
+    def __init__(self, mirror_dir, max_bytes):
+        self.mirror_dir = Path(mirror_dir)
+        self.max_bytes = max_bytes
+
+    def path(self, source):
+        """ Returns the path of the uncompressed copy of source, creating it if needed."""
+        source = Path(source)
+        stat = source.stat()
+        key = hashlib.sha1(source.resolve().as_posix().encode()).hexdigest()
+        mirror_path = self.mirror_dir.joinpath('%s_%i_%i.nii' % (key, stat.st_size, stat.st_mtime_ns))
+        if not mirror_path.exists():
+            self.mirror_dir.mkdir(parents=True, exist_ok=True)
+            for stale in self.mirror_dir.glob(key + '_*.nii'): # copies of an older version of the source
+                stale.unlink()
+            tmp_path = mirror_path.with_suffix('.%i.tmp' % os.getpid())
+            with gzip.open(source, 'rb') as f_in, open(tmp_path, 'wb') as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+            os.replace(tmp_path, mirror_path)
+            self.evict()
+        os.utime(mirror_path, (time.time(), mirror_path.stat().st_mtime)) # access time for the LRU eviction
+        return mirror_path
+
+    def load(self, source, keep_file_open=False):
+        """ Loads source as a nibabel image, memory-mapped from the uncompressed copy."""
+        if not Path(source).name.endswith('.gz'):
+            return nib.load(source, mmap=True, keep_file_open=keep_file_open)
+        return nib.load(self.path(source), mmap=True, keep_file_open=keep_file_open)
+
+    def evict(self):
+        """ Removes the least recently used copies until the mirror fits in max_bytes."""
+        copies = [(f.stat(), f) for f in self.mirror_dir.glob('*.nii')]
+        total = sum(stat.st_size for stat, f in copies)
+        now = time.time()
+        for stat, f in sorted(copies, key=lambda copy: copy[0].st_atime):
+            if total <= self.max_bytes:
+                break
+            if now - stat.st_atime < 60:
+                continue
+            try:
+                f.unlink()
+            except FileNotFoundError: # evicted by another process
+                pass
+            total -= stat.st_size
+
+
+def enable(mirror_dir, max_gb):
+    """ Makes load_nifti use a mirror in mirror_dir of at most max_gb gigabytes (also in worker processes)."""
+    os.environ[MIRROR_DIR_VARIABLE] = Path(mirror_dir).as_posix()
+    os.environ[MIRROR_SIZE_VARIABLE] = str(int(max_gb * 2**30))
+
+
+def load_nifti(source, keep_file_open=False):
+    """ Loads a NIfTI file, through the mirror if one is enabled.
+
+    Parameters:
+        source : the path of the NIfTI file
+        keep_file_open : keep the file open between reads of the array proxy, for images read in many parts
+            (without it, every read of a .nii.gz opens the file again and decompresses it from the start)
+    """
+    if MIRROR_DIR_VARIABLE not in os.environ:
+        return nib.load(source, keep_file_open=keep_file_open)
+    return NiftiMirror(os.environ[MIRROR_DIR_VARIABLE], int(os.environ[MIRROR_SIZE_VARIABLE])).load(source, keep_file_open)
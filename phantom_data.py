@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# the data of the dashboard: the full_data tables of all scanners joined with the report links and event notes,
+# kept in a snapshot file so that the dashboard starts without redoing the pandas work, and kept up to date
+# while the dashboard runs (DashboardData)
+
+import hashlib
+import io
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from phantom_events import EventsFile, attach_notes, read_events
+
+scanners = ['Prisma','Prismafit','Skyra'] # a list of scanner names
+qc_types = {'fMRI':'fMRI','short':'Individual coil check'} # a list of QC types
+snapshot_name = 'dashboard_snapshot.npz'
+report_url = '/reports' # the reports are served by the dashboard under this URL (see phantom_reports.py)
+snapshot_version = 3 # increase when the content of the snapshot changes
+
+
+def read_file(default_path, path_to_data, **read_options):
+    """ Read the path (absolute or relative to the default path) or throw an error"""
+    if Path(path_to_data).exists():
+        pass
+    elif default_path.joinpath(path_to_data).exists():
+        path_to_data = default_path.joinpath(path_to_data)
+    else:
+        raise FileNotFoundError('File ' + str(path_to_data) + ' or '+str(default_path.joinpath(path_to_data))+' does not exist')
+    return pd.read_csv(path_to_data, **read_options)
+
+
+def data_files(default_path): # the full_data table of each scanner and QC type
+    return {(scanner, qc_type): default_path.joinpath('sub-%s/full_data_%s.csv' % (scanner, qc_type)) for scanner in scanners for qc_type in qc_types}
+
+
+def source_files(default_path): # the files the dashboard data is made from
+    return list(data_files(default_path).values()) + [default_path.joinpath('events.csv')]
+
+
+def source_signature(default_path): # changes when a source file is written (or the dashboard moves to another path)
+    return [snapshot_version, str(default_path), scanners, list(qc_types)] + \
+           [(f.as_posix(), f.stat().st_mtime_ns if f.exists() else None) for f in source_files(default_path)]
+
+
+def report_links(df): # the URL of the report of each session, as string concatenation over whole columns
+    suffix = df['qc_type'].eq('fMRI').map({True: '_fMRI', False: ''})
+    return report_url + '/sub-' + df['scanner'].astype(str) + '/ses-' + df['date'].astype(str) + '_phantom' + suffix + '.html'
+
+
+def add_links(full_df): # the report links, and the dates parsed
+    full_df['link'] = report_links(full_df)
+    full_df.date = pd.to_datetime(full_df.date, format='%Y%m%d')
+
+
+def fill_alerts(full_df): # drift alerts of the preprocessing (see phantom_drift.py), '' if the session is in control
+    alert_columns = [column for column in full_df.columns if column.endswith('_alert')]
+    full_df[alert_columns] = full_df[alert_columns].fillna('')
+
+
+def build_data(default_path):
+    """ Reads and joins the dashboard data.
+
+    Returns:
+        full_df : the sessions of all scanners and QC types (scanner, qc_type, date as datetime, the metrics,
+            link with the URL of the report, paul_notes with the event notes and the *_alert columns as strings)
+        df_events : the events, with date_start and date_end as datetimes
+    """
+    df_list = []
+    for scanner in scanners:
+        for qc_type in qc_types:
+            df = read_file(default_path, 'sub-%s/full_data_%s.csv' % (scanner, qc_type))
+            df['scanner'] = scanner
+            df['qc_type'] = qc_type
+            df_list.append(df)
+    full_df = pd.concat(df_list)
+    add_links(full_df)
+    fill_alerts(full_df)
+
+    if not default_path.joinpath('events.csv').exists():
+        raise FileNotFoundError('File ' + str(default_path.joinpath('events.csv')) + ' does not exist')
+    df_events = read_events(default_path.joinpath('events.csv'))
+    attach_notes(full_df, df_events)
+    return full_df, df_events
+
+
+def frame_arrays(name, df):
+    """ Returns the index and columns of a data frame as plain arrays (named name.index, name.0, name.1, ...) and
+    the column names, with whether each column holds strings. String columns are stored as unicode arrays with
+    a mask of their missing values (name.<i>.missing), so that no array needs pickle to be read."""
+    arrays = {name + '.index': df.index.to_numpy()}
+    columns = list()
+    for i, column in enumerate(df.columns):
+        values = df.iloc[:, i]
+        strings = values.dtype == object or pd.api.types.is_string_dtype(values.dtype)
+        if strings:
+            arrays['%s.%i.missing' % (name, i)] = values.isna().to_numpy()
+            values = values.where(values.notna(), '').astype(str).to_numpy().astype(str)
+        arrays['%s.%i' % (name, i)] = np.asarray(values)
+        columns.append((column, bool(strings)))
+    return arrays, columns
+
+
+def read_frame(snapshot, name, columns): # the data frame that frame_arrays stored in the snapshot
+    data = dict()
+    for i, (column, strings) in enumerate(columns):
+        values = snapshot['%s.%i' % (name, i)]
+        if strings:
+            values = values.astype(object)
+            values[snapshot['%s.%i.missing' % (name, i)]] = np.nan
+        data[i] = values
+    df = pd.DataFrame(data, index=snapshot[name + '.index'], columns=range(len(columns)))
+    df.columns = [column for column, strings in columns]
+    return df
+
+
+def write_snapshot(default_path, data=None, signature=None):
+    """ Writes the dashboard data (built now if not given) to the snapshot file, together with the modification
+    times of its sources (signature, taken before the data was built); returns the data.
+
+    The snapshot is an .npz file of plain arrays (see frame_arrays) and a JSON description, so it is read without
+    pickle: the BIDS directory is shared, and unpickling a file written there could run any code."""
+    if data is None:
+        signature = source_signature(default_path)
+        data = build_data(default_path)
+    arrays = dict()
+    frames = dict()
+    for name, df in zip(['full_df', 'df_events'], data):
+        frame, frames[name] = frame_arrays(name, df)
+        arrays.update(frame)
+    arrays['description'] = np.array(json.dumps({'signature': signature, 'frames': frames}))
+    snapshot_file = default_path.joinpath(snapshot_name)
+    tmp_file = snapshot_file.with_name('%s.%i.tmp' % (snapshot_file.name, os.getpid()))
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_file, snapshot_file)
+    return data
+
+
+def read_snapshot(snapshot_file, signature):
+    """ Returns the dashboard data from the snapshot file, None if it was written from other sources (signature)."""
+    with np.load(snapshot_file, allow_pickle=False) as snapshot:
+        description = json.loads(snapshot['description'].item())
+        if description['signature'] != json.loads(json.dumps(signature)): # as read back from JSON (tuples are lists)
+            return None
+        return tuple(read_frame(snapshot, name, description['frames'][name]) for name in ['full_df', 'df_events'])
+
+
+def load_data(default_path):
+    """ Returns the dashboard data (see build_data) from the snapshot if its sources did not change since it was
+    written, otherwise builds it and writes a new snapshot (if the directory is writable)."""
+    snapshot_file = default_path.joinpath(snapshot_name)
+    signature = source_signature(default_path)
+    if snapshot_file.exists():
+        try:
+            data = read_snapshot(snapshot_file, signature)
+            if data is not None:
+                return data
+        except Exception as e: # e.g. a partly written or foreign file
+            print('Snapshot %s not used: %s' % (snapshot_file, e))
+    data = build_data(default_path)
+    try:
+        write_snapshot(default_path, data, signature)
+    except OSError as e:
+        print('Snapshot %s not written: %s' % (snapshot_file, e))
+    return data
+
+
+def file_state(path): # modification time, size and hash of the content of a file, None if it does not exist
+    try:
+        mtime = path.stat().st_mtime_ns
+        content = path.read_bytes()
+    except OSError:
+        return None
+    return mtime, len(content), hashlib.sha1(content).hexdigest()
+
+
+class DashboardData:
+    """ The data of a running dashboard (see build_data), kept up to date with the full_data CSVs and events.csv.
+
+    refresh() checks the modification times of the files: sessions added at the end of a CSV (the preprocessing
+    only appends rows for new sessions, so the file starts with the bytes it had) are appended to the data, any
+    other change of a CSV replaces its rows, and a change of events.csv updates the notes. Each refresh that
+    changes something increases the version and logs the kinds of change, so that a page can be sent only what
+    changed since the version it shows (see since). The data frame is replaced, never changed in place, so a
+    callback can keep using the one it got while a refresh runs.
+
+    Parameters:
+        default_path : the BIDS directory
+    """
+
+    def __init__(self, default_path):
+        self.default_path = default_path
+        self.lock = threading.Lock()
+        self.session = uuid.uuid4().hex # tells the versions of this run from those of pages of an earlier run
+        self.version = 0
+        self.log = list() # (version, set of 'append', 'replace' and 'events') of each refresh that changed the data
+        self.events = EventsFile(default_path.joinpath('events.csv'))
+        # taken before the data is loaded, a file written meanwhile is read again by the first refresh
+        self.files = {key: file_state(path) for key, path in data_files(default_path).items()}
+        full_df, df_events = load_data(default_path) # with the notes of the events.csv it was built from
+        if self.events.refresh(): # events.csv changed since it was read above, the stored notes may be older
+            attach_notes(full_df, self.events.df_events)
+        self.full_df = full_df.assign(data_version=self.version) # the version that added each row
+
+    def refresh(self):
+        """ Reads the files that changed since the last refresh; returns whether the data changed."""
+        with self.lock:
+            full_df = self.full_df
+            kinds = set()
+            additions = list()
+            for (scanner, qc_type), path in data_files(self.default_path).items():
+                state = self.files[(scanner, qc_type)]
+                if not path.exists(): # removed, its sessions are kept
+                    continue
+                try:
+                    mtime = path.stat().st_mtime_ns # before reading, a file written meanwhile is read again
+                    if state is not None and mtime == state[0]:
+                        continue
+                    content = path.read_bytes()
+                    df = pd.read_csv(io.BytesIO(content))
+                    df['scanner'] = scanner
+                    df['qc_type'] = qc_type
+                    add_links(df)
+                except (OSError, ValueError, KeyError, pd.errors.ParserError) as e: # e.g. being written, tried again at the next refresh
+                    print('%s not read: %s' % (path, e))
+                    continue
+                self.files[(scanner, qc_type)] = (mtime, len(content), hashlib.sha1(content).hexdigest())
+                rows = (full_df['scanner'] == scanner) & (full_df['qc_type'] == qc_type)
+                if state is not None and state[1] < len(content) and content[state[1] - 1:state[1]] == b'\n' and \
+                        hashlib.sha1(content[:state[1]]).hexdigest() == state[2]:
+                    df = df.iloc[rows.sum():]
+                    if df.empty:
+                        continue
+                    kinds.add('append')
+                else:
+                    full_df = full_df[~rows]
+                    kinds.add('replace')
+                additions.append(df)
+            if self.events.refresh():
+                kinds.add('events')
+            if not kinds:
+                return False
+            full_df = pd.concat([full_df] + [df.assign(data_version=self.version + 1) for df in additions])
+            fill_alerts(full_df)
+            attach_notes(full_df, self.events.df_events)
+            self.full_df = full_df
+            self.version += 1
+            self.log.append((self.version, kinds))
+            return True
+
+    def current(self): # the data and its version
+        with self.lock:
+            return self.full_df, self.version
+
+    def since(self, session, version):
+        """ Returns the data, its version and the kinds of change after the given version of the session (a set,
+        None if the version is not one of this run, e.g. a page of an earlier run of the dashboard)."""
+        with self.lock:
+            if session != self.session or version is None or version > self.version:
+                return self.full_df, self.version, None
+            return self.full_df, self.version, set().union(*[kinds for v, kinds in self.log if v > version])
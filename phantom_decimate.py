@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# decimation of long metric histories for the temporal plots: a few points per screen pixel keep the shape of a series
+
+import numpy as np
+
+decimation_methods = ['lttb', 'minmax']
+
+
+def lttb(x, y, n):
+    """ Returns the indices of n points of the series chosen by Largest-Triangle-Three-Buckets: the first and the
+    last point, and in each of n-2 buckets in between the point that forms the largest triangle with the point
+    chosen in the previous bucket and the mean of the next bucket.
+
+    Parameters:
+        x, y : float arrays, x sorted
+        n : number of points, at least 3
+    """
+    size = len(x)
+    if size <= n:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, n - 1).astype(int) # buckets [edges[i], edges[i+1]), each with at least one point
+    chosen = np.empty(n, dtype=int)
+    chosen[0], chosen[-1] = 0, size - 1
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < n - 1 else size
+        mean_x, mean_y = x[end:next_end].mean(), y[end:next_end].mean()
+        a = chosen[i]
+        areas = np.abs((x[a] - mean_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y - y[a]))
+        chosen[i + 1] = start + np.argmax(areas)
+    return chosen
+
+
+def min_max(y, n):
+    """ Returns the indices of the minimum and the maximum of each of n/2 buckets of the series, in order."""
+    size = len(y)
+    if size <= n:
+        return np.arange(size)
+    edges = np.linspace(0, size, n // 2 + 1).astype(int)
+    chosen = list()
+    for start, end in zip(edges[:-1], edges[1:]):
+        chosen += sorted({start + int(np.argmin(y[start:end])), start + int(np.argmax(y[start:end]))})
+    return np.array(chosen)
+
+
+def decimate(x, y, n, method='lttb'):
+    """ Returns the indices of at most n points of the series that keep its shape, all of them if there are at most n.
+
+    Parameters:
+        x, y : float arrays, x sorted; points where y is not finite are left out of a decimated series
+        n : number of points, at least 3
+        method : 'lttb' (lttb) or 'minmax' (min_max)
+    """
+    if len(x) <= n:
+        return np.arange(len(x))
+    finite = np.flatnonzero(np.isfinite(y))
+    chosen = lttb(x[finite], y[finite], n) if method == 'lttb' else min_max(y[finite], n)
+    return finite[chosen]
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# incremental drift and change point detection on the metric histories of the phantom sessions
+
+import numpy as np
+import pandas as pd
+
+# parameters of the trackers per modality (the stored states don't depend on them, but their results do);
+# the T1 limits are wider, each session has 128 coil series (about 1 in 10 sessions of pure noise would have an alert
+# with the fMRI limits, which give a false alert in about 1 in 100 sessions per series)
+drift_parameters = {'fMRI': {'window': 40, 'min_baseline': 10, 'limit': 3.5, 'k': 0.5, 'h': 6.0, 'rebaseline': 5},
+                    'T1': {'window': 40, 'min_baseline': 10, 'limit': 5.0, 'k': 0.5, 'h': 12.0, 'rebaseline': 5}}
+
+
+class DriftTracker:
+    """ Running robust baseline, control limits and CUSUM of one metric of one scanner, updated one session at a time.
+
+    The baseline is the median and the MAD (scaled to a standard deviation) of the last window in-control values,
+    so an update costs the same however long the history is. A value is out of the control limits if it is more
+    than limit robust standard deviations from the median. The two-sided CUSUM of the standardized values
+    (allowance k, decision interval h, both in standard deviations) signals smaller, persistent shifts and restarts
+    after a signal; the values are clipped to the limits in the CUSUM, so that a single outlier does not trigger it.
+    Values out of the limits are kept out of the baseline, unless rebaseline of them follow each other: that is
+    taken as a change point (e.g. a hardware change or a new phantom) and the baseline restarts from them.
+    No alerts are given while the baseline has fewer than min_baseline values.
+
+    Parameters:
+        state : dict from an earlier state() to continue from, None to start a new history
+    """
+
+    def __init__(self, state=None, window=40, min_baseline=10, limit=3.5, k=0.5, h=6.0, rebaseline=5):
+        state = state or {'baseline': [], 'outliers': [], 'cusum_pos': 0.0, 'cusum_neg': 0.0}
+        self.baseline = list(state['baseline'])
+        self.outliers = list(state['outliers']) # consecutive values out of the limits
+        self.cusum_pos = state['cusum_pos']
+        self.cusum_neg = state['cusum_neg']
+        self.window = window
+        self.min_baseline = min_baseline
+        self.limit = limit
+        self.k = k
+        self.h = h
+        self.rebaseline = rebaseline
+
+    def state(self):
+        return {'baseline': self.baseline, 'outliers': self.outliers, 'cusum_pos': self.cusum_pos, 'cusum_neg': self.cusum_neg}
+
+    def update(self, value):
+        """ Adds the value of the next session.
+
+        Returns:
+            result : (value, center, lower, upper, z, cusum_pos, cusum_neg, alert), the baseline statistics are those
+                before the value and NaN while the baseline is too short; alert is '' or a description such as
+                'high', 'low', 'drift up', 'drift down' and 'change point'
+        """
+        value = float(value)
+        if np.isnan(value): # e.g. a missing coil, the state does not change
+            return value, np.nan, np.nan, np.nan, np.nan, self.cusum_pos, self.cusum_neg, ''
+        if len(self.baseline) < self.min_baseline:
+            self.baseline.append(value)
+            return value, np.nan, np.nan, np.nan, np.nan, self.cusum_pos, self.cusum_neg, ''
+        center = float(np.median(self.baseline))
+        scale = max(1.4826 * float(np.median(np.abs(np.array(self.baseline) - center))), 1e-3 * abs(center), 1e-12)
+        z = (value - center) / scale
+        clipped = min(max(z, -self.limit), self.limit)
+        self.cusum_pos = max(0.0, self.cusum_pos + clipped - self.k)
+        self.cusum_neg = max(0.0, self.cusum_neg - clipped - self.k)
+        cusum_pos, cusum_neg = self.cusum_pos, self.cusum_neg
+        alerts = ['high' if z > self.limit else 'low'] if abs(z) > self.limit else []
+        if self.cusum_pos > self.h:
+            alerts.append('drift up')
+            self.cusum_pos = 0.0
+        if self.cusum_neg > self.h:
+            alerts.append('drift down')
+            self.cusum_neg = 0.0
+        if abs(z) > self.limit:
+            self.outliers.append(value)
+            if len(self.outliers) >= self.rebaseline: # a new level, not a series of outliers
+                self.baseline, self.outliers = self.outliers, []
+                self.cusum_pos = self.cusum_neg = 0.0
+                alerts.append('change point')
+        else:
+            self.outliers = []
+            self.baseline = (self.baseline + [value])[-self.window:]
+        return value, center, center - self.limit * scale, center + self.limit * scale, z, cusum_pos, cusum_neg, ', '.join(alerts)
+
+
+def update_drift(store, scanner, modality, df):
+    """ Updates the drift statistics of a scanner and modality with the sessions after their stored states.
+
+    Parameters:
+        store : the MetricsStore that keeps the results and states
+        df : wide table of the sessions, one row per date (int, YYYYMMDD) and one column per series;
+            only the rows after the stored state of a series are used
+
+    Returns:
+        sessions : the number of (session, series) updates
+    """
+    states = store.drift_states(scanner, modality)
+    rows = list()
+    new_states = dict()
+    for series in df.columns:
+        last_date, state = states.get(series, (None, None))
+        values = df[series] if last_date is None else df[series][df.index > int(last_date)]
+        if values.empty:
+            continue
+        tracker = DriftTracker(state, **drift_parameters[modality])
+        rows += [(date, series) + tracker.update(value) for date, value in values.items()]
+        new_states[series] = (values.index[-1], tracker.state())
+    store.write_drift(scanner, modality, rows, new_states)
+    return len(rows)
+
+
+def alert_columns(store, scanner, modality, groups):
+    """ Returns the alerts of a scanner and modality as text columns, one per group of series.
+
+    Parameters:
+        groups : dict of column name to a function that tells whether a series belongs to the column
+
+    Returns:
+        alerts : DataFrame with one row per date (int) with an alert, e.g. 'tSNR low' or 'signal_proportion_C05 drift up; ...'
+    """
+    df = store.drift_frame(scanner, modality, alerts_only=True)
+    df['date'] = df['date'].astype(int)
+    df['text'] = df['series'] + ' ' + df['alert']
+    alerts = pd.DataFrame({column: df[df['series'].map(belongs).astype(bool)].groupby('date')['text'].agg('; '.join)
+                           for column, belongs in groups.items()}, columns=list(groups))
+    alerts.index.name = 'date'
+    return alerts.fillna('')
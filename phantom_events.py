@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# the scanner events of events.csv (service visits, upgrades, ...): their notes on the sessions and their marks on the temporal plots
+
+import heapq
+import threading
+
+import numpy as np
+import pandas as pd
+
+# choose colors based on the scanner id
+event_colors = {"Skyra": "Blue", "Prismafit": "Green", "Prisma": "Orange", "Multiple": "Black"}
+
+
+def read_events(events_file):
+    """ Reads events.csv (scanner, date_start, date_end as dd/mm/YYYY, description, long_description); an event of
+    scanner 'Multiple' applies to all scanners."""
+    df_events = pd.read_csv(events_file)
+    df_events['date_start'] = pd.to_datetime(df_events['date_start'], format='%d/%m/%Y')
+    df_events['date_end'] = pd.to_datetime(df_events['date_end'], format='%d/%m/%Y')
+    return df_events
+
+
+def event_segments(df_events):
+    """ Splits the time line into segments that are covered by the same events, in one sweep over the sorted events.
+
+    Returns:
+        segments : IntervalIndex of non-overlapping [start, end) segments in int64 nanoseconds (the events include their end date)
+        last_events : per segment the row position of the last event in df_events that covers it, -1 if none does
+    """
+    starts = df_events['date_start'].to_numpy('datetime64[ns]').astype(np.int64)
+    ends = df_events['date_end'].to_numpy('datetime64[ns]').astype(np.int64) + 1
+    breaks = np.unique(np.concatenate([starts, ends]))
+    last_events = np.full(max(len(breaks) - 1, 0), -1)
+    order = np.argsort(starts, kind='stable')
+    active = list() # heap of (-position, end) of the events that started, the last one on top
+    j = 0
+    for i, left in enumerate(breaks[:-1]):
+        while j < len(order) and starts[order[j]] <= left:
+            heapq.heappush(active, (-order[j], ends[order[j]]))
+            j += 1
+        while active and active[0][1] <= left: # ended, removed only when on top
+            heapq.heappop(active)
+        if active:
+            last_events[i] = -active[0][0]
+    return pd.IntervalIndex.from_breaks(breaks, closed='left'), last_events
+
+
+def event_notes(full_df, df_events):
+    """ Returns the long description of the last event (in the order of the file) of its scanner, or of all scanners,
+    that includes the date of each session of full_df, '' if there is none.
+
+    The events of a scanner are split into segments once (event_segments), so this takes O((n+m) log m)
+    for n sessions and m events instead of a pass over all sessions per event.
+    """
+    notes = np.full(len(full_df), '', dtype=object)
+    session_scanners = full_df['scanner'].to_numpy()
+    dates = full_df['date'].to_numpy('datetime64[ns]').astype(np.int64)
+    for scanner in pd.unique(session_scanners):
+        events = df_events[(df_events['scanner'] == scanner) | (df_events['scanner'] == 'Multiple')]
+        if events.empty:
+            continue
+        segments, last_events = event_segments(events)
+        if len(segments) == 0:
+            continue
+        rows = np.flatnonzero(session_scanners == scanner)
+        positions = segments.get_indexer(dates[rows])
+        events_of_rows = np.where(positions >= 0, last_events[positions], -1)
+        found = events_of_rows >= 0
+        notes[rows[found]] = events['long_description'].to_numpy(dtype=object)[events_of_rows[found]]
+    return notes
+
+
+def attach_notes(full_df, df_events): # the notes of the events as the paul_notes column
+    full_df['paul_notes'] = event_notes(full_df, df_events)
+
+
+def event_marks(df_events):
+    """ Returns the shapes (a colored bar per event) and annotations (its description) for the layout of the temporal plots."""
+    shapes_lines = [{'type': 'rect',
+                     'xref': 'x',
+                     'yref': 'paper',
+                     'x0': row.date_start,
+                     'y0': 0.5,
+                     'x1': row.date_end,
+                     'y1': 0.6,
+                     'line': {'color': event_colors.get(row.scanner),
+                              'width': 2
+                              },
+                     'fillcolor': event_colors.get(row.scanner),
+                     'opacity': 0.3
+                     } for row in df_events.itertuples()]
+    annotations = [{'text': row.description,
+                    'xref': 'x',
+                    'yref': 'paper',
+                    'x': row.date_start + (row.date_end - row.date_start) / 2,
+                    'y': .45,
+                    'showarrow': False
+                    } for row in df_events.itertuples()]
+    return shapes_lines, annotations
+
+
+class EventsFile:
+    """ events.csv, read again when its modification time changes (e.g. a note was added while the dashboard runs).
+
+    Parameters:
+        events_file : the path of events.csv
+    """
+
+    def __init__(self, events_file):
+        self.events_file = events_file
+        self.lock = threading.Lock()
+        self.version = events_file.stat().st_mtime_ns
+        self.df_events = read_events(events_file)
+
+    def refresh(self):
+        """ Reads the file again if it changed; returns whether it did."""
+        with self.lock:
+            try:
+                version = self.events_file.stat().st_mtime_ns
+                if version == self.version:
+                    return False
+                self.df_events = read_events(self.events_file)
+            except (OSError, ValueError, KeyError, pd.errors.ParserError) as e: # e.g. being saved, tried again at the next refresh
+                print('%s not read: %s' % (self.events_file, e))
+                return False
+            self.version = version
+            return True
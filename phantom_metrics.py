@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+# numerical routines shared by the phantom preprocessing scripts
+
+import numpy as np
+from scipy.spatial import ConvexHull
+from scipy.spatial.distance import cdist
+
+
+def centers_of_mass(data):
+    """ Computes the center of mass of every volume of a stack in one vectorized pass.
+
+    Gives the same result as calling scipy.ndimage.center_of_mass on each volume separately. The only pass
+    over the full array is one matrix product that gives, for all volumes at once, the plain and the
+    coordinate-weighted sums along the first axis; the other axes are reduced from those partial sums,
+    which are smaller than the array by the size of the first axis.
+
+    Parameters:
+        data : an array with the spatial axes first and the volumes (time points, coils) on the last axis
+
+    Returns:
+        coms : a (volumes x spatial axes) array with the center of mass of each volume
+    """
+    n_spatial = data.ndim - 1
+    dtype = data.dtype if data.dtype.kind == 'f' else np.float64
+    weights = np.stack([np.ones(data.shape[0]), np.arange(data.shape[0])]).astype(dtype)
+    order = 'F' if data.flags.f_contiguous and not data.flags.c_contiguous else 'C' # the reshapes are views of Fortran ordered arrays too (as returned by nibabel)
+    sums = weights @ data.reshape(data.shape[0], -1, order=order)
+    partial, first_moment = (s.reshape(data.shape[1:], order=order) for s in sums)
+    partial_axes = tuple(range(n_spatial - 1)) # the spatial axes of the partial sums
+    coms = np.empty((data.shape[-1], n_spatial))
+    coms[:, 0] = first_moment.sum(axis=partial_axes)
+    for axis in range(1, n_spatial):
+        profile = partial.sum(axis=tuple(a for a in partial_axes if a != axis - 1)) # signal profile along the axis for every volume
+        coms[:, axis] = np.arange(data.shape[axis]) @ profile
+    total = partial.sum(axis=partial_axes)
+    return coms / total[:, np.newaxis]
+
+
+def max_pairwise_distance(points):
+    """ Finds the largest euclidean distance between any two points without the full distance matrix.
+
+    The farthest pair of a point cloud always lies on its convex hull, so only the hull vertices
+    are compared. Degenerate clouds (too few or coplanar points) fall back to the direct comparison.
+
+    Parameters:
+        points : a (points x dimensions) array, e.g. the centers of mass of all volumes
+
+    Returns:
+        the maximum distance (0 for a single point)
+    """
+    points = np.unique(np.asarray(points, dtype=float), axis=0)
+    if len(points) > points.shape[1] + 1:
+        try:
+            points = points[ConvexHull(points).vertices]
+        except RuntimeError: # QhullError for flat point clouds, keep all points then
+            pass
+    return cdist(points, points, metric='euclidean').max()
+
+
+def tsnr_maps(data):
+    """ Computes the temporal SNR, mean and standard deviation maps of a 4D run in memory.
+
+    Follows nipype.algorithms.confounds.TSNR (without detrending): the tSNR is the temporal mean
+    divided by the temporal standard deviation, and stays 0 where the standard deviation is below 1e-3.
+
+    Parameters:
+        data : a 4D array with the volumes on the last axis
+
+    Returns:
+        tsnr, mean, stddev : 3D arrays
+    """
+    mean = data.mean(axis=-1)
+    stddev = data.std(axis=-1)
+    return tsnr_from_moments(mean, stddev), mean, stddev
+
+
+def tsnr_from_moments(mean, stddev):
+    """ Computes the tSNR map from the temporal mean and standard deviation maps (0 where stddev < 1e-3)."""
+    tsnr = np.zeros_like(mean)
+    nonzero = stddev > 1.0e-3
+    tsnr[nonzero] = mean[nonzero] / stddev[nonzero]
+    return tsnr
+
+
+def stream_run_statistics(dataobj, chunk_size=16, precision=np.float64, max_memory=None, reserved=0):
+    """ Reduces a 4D run chunk by chunk, keeping only running accumulators in memory.
+
+    Volumes are read one at a time from the (proxy) array into a preallocated chunk of chunk_size volumes
+    in precision, so the float64 copy that nibabel makes of a scaled volume (scl_slope) exists for one volume
+    only. The temporal mean and variance of each chunk are added to the accumulators with the Welford/Chan
+    update, in place, and the centers of mass are computed per chunk, so the full run is never loaded at once.
+
+    Parameters:
+        dataobj : a nibabel array proxy (img.dataobj) or an array with the volumes on the last axis
+        chunk_size : the maximum number of volumes read at once
+        precision : the float type of the chunks and accumulators (np.float32 or np.float64)
+        max_memory : the memory ceiling in bytes, None for no limit. It covers the chunk, the volume being read
+            (in its type on disk and as float64), the accumulators and maps of a chunk, the centers of mass and
+            the reserved bytes; the chunk size is reduced to fit, and a MemoryError is raised if not even one
+            volume fits
+        reserved : bytes of max_memory kept for the caller, e.g. for the maps it derives from the result
+
+    Returns:
+        mean, stddev : 3D maps of the temporal mean and standard deviation
+        coms : a (volumes x 3) array with the center of mass of each volume
+    """
+    shape = dataobj.shape
+    voxels = int(np.prod(shape[:-1]))
+    volume_bytes = voxels * np.dtype(precision).itemsize
+    if max_memory is not None:
+        # the volume read (in its type on disk and scaled to float64), the accumulators (mean, m2), the maps of a chunk
+        # (its mean and sum of squares and the mean update, up to four at once) and the centers of mass
+        fixed = voxels * (2 * np.dtype(getattr(dataobj, 'dtype', precision)).itemsize + 8) + 6 * volume_bytes + shape[-1] * 3 * 8
+        # a volume of the chunk, and its share of the partial sums of the centers of mass
+        per_volume = volume_bytes + 2 * volume_bytes // shape[0]
+        chunk_size = min(chunk_size, (int(max_memory) - int(reserved) - fixed) // per_volume)
+        if chunk_size < 1:
+            raise MemoryError('Memory limit of %i bytes is too small for volumes of %i bytes' % (max_memory, volume_bytes))
+
+    n = 0
+    mean = np.zeros(shape[:-1], dtype=precision)
+    m2 = np.zeros(shape[:-1], dtype=precision) # sum of squared deviations from the mean
+    coms = np.empty((shape[-1], len(shape) - 1))
+    buffer = np.empty(shape[:-1] + (min(chunk_size, shape[-1]),), dtype=precision, order='F') # volumes stay contiguous
+    for start in range(0, shape[-1], chunk_size):
+        n_chunk = min(chunk_size, shape[-1] - start)
+        chunk = buffer[..., :n_chunk]
+        for i in range(n_chunk):
+            chunk[..., i] = dataobj[..., start + i]
+        coms[start:start + n_chunk] = centers_of_mass(chunk)
+        delta = chunk.mean(axis=-1)
+        np.subtract(chunk, delta[..., np.newaxis], out=chunk) # the deviations from the chunk mean, the chunk is not needed anymore
+        np.square(chunk, out=chunk)
+        chunk_m2 = chunk.sum(axis=-1)
+        delta -= mean
+        mean += delta * (n_chunk / (n + n_chunk))
+        np.square(delta, out=delta)
+        delta *= n * n_chunk / (n + n_chunk)
+        m2 += chunk_m2
+        m2 += delta
+        n += n_chunk
+        del delta, chunk_m2
+    m2 /= n
+    return mean, np.sqrt(m2, out=m2), coms
+
+
+def roi_timeseries(data, roi):
+    """ Computes the mean of the nonzero voxels inside a box-shaped ROI for every volume.
+
+    Only the box is read, one volume at a time, so data can be a nibabel array proxy as well as an array
+    and the memory used does not grow with the length of the run.
+
+    Parameters:
+        data : a 4D array or array proxy with the volumes on the last axis
+        roi : a tuple of three slices defining the box
+
+    Returns:
+        timeseries : a 1D array with one value per volume
+    """
+    timeseries = np.empty(data.shape[-1])
+    for t in range(data.shape[-1]):
+        box = np.asarray(data[tuple(roi) + (t,)], dtype=float)
+        timeseries[t] = box.sum() / np.count_nonzero(box)
+    return timeseries
+
+
+
+def weisskoff(data, center, widths=range(1, 21), depth=1):
+    """ Computes the Weisskoff analysis: the fluctuation of the ROI mean against the ROI width.
+
+    Square ROIs of width n x n (x depth slices) are nested around the same center. Only the box around
+    the largest ROI is read, and a summed-volume table (cumulative sums along the three spatial axes)
+    of that box gives the ROI sum of every volume from 8 table entries, whatever the ROI size.
+    The fluctuation is the standard deviation of the ROI mean after removing a 2nd order polynomial
+    trend, in percent of the mean. The radius of decorrelation (RDC) is the width at which the
+    fluctuation of an ideal (1/n) phantom would reach the fluctuation of the largest ROI.
+
+    Parameters:
+        data : a 4D array or nibabel array proxy with the volumes on the last axis
+        center : the (x, y, z) voxel around which the ROIs are centered
+        widths : the increasing ROI widths in voxels
+        depth : the number of slices of the ROIs
+
+    Returns:
+        widths : an array with the ROI widths
+        fluctuations : an array with the fluctuation (%) for each width
+        rdc : the radius of decorrelation in voxels
+    """
+    widths = np.asarray(widths)
+    n_max = widths.max()
+    start = [int(center[0]) - n_max // 2, int(center[1]) - n_max // 2, int(center[2]) - depth // 2]
+    stop = [start[0] + n_max, start[1] + n_max, start[2] + depth]
+    if min(start) < 0 or any(b > s for b, s in zip(stop, data.shape[:3])):
+        raise ValueError('The ROIs of up to %i voxels around %s do not fit in the image' % (n_max, tuple(center)))
+    box = np.asarray(data[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2], :], dtype=float)
+
+    table = np.zeros((n_max + 1, n_max + 1, depth + 1, box.shape[3])) # summed-volume table, padded with zeros
+    table[1:, 1:, 1:] = box.cumsum(axis=0).cumsum(axis=1).cumsum(axis=2)
+
+    time = np.arange(box.shape[3])
+    fluctuations = np.empty(len(widths))
+    for i, n in enumerate(widths):
+        a = n_max // 2 - n // 2 # start of the ROI within the box
+        b = a + n
+        roi_sum = (table[b, b, depth] - table[a, b, depth] - table[b, a, depth] - table[b, b, 0]
+                   + table[a, a, depth] + table[a, b, 0] + table[b, a, 0] - table[a, a, 0])
+        roi_mean = roi_sum / (n * n * depth)
+        residuals = roi_mean - np.polyval(np.polyfit(time, roi_mean, 2), time)
+        fluctuations[i] = 100 * residuals.std() / roi_mean.mean()
+    rdc = widths[0] * fluctuations[0] / fluctuations[-1]
+    return widths, fluctuations, rdc
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+
+# rendering of the phantom QC figures, separated from the metric computation
+
+import hashlib
+import json
+import os
+import struct
+import threading
+import zlib
+from functools import partial
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg') # headless, the figures are only written to files
+import matplotlib.pyplot as plt
+import nibabel as nib
+import numpy as np
+from nilearn.image import new_img_like
+from nilearn.plotting import plot_anat
+
+from helpers import parallel_map
+from nifti_mirror import load_nifti
+from phantom_trace import traced
+
+render_modes = ['inline', 'deferred', 'lazy']
+
+# one figure per kind of plot and worker process, cleared and reused instead of created and torn down for every image
+_figures = dict()
+_render_lock = threading.Lock() # pyplot is not thread safe, the pipeline may render from several threads
+
+
+def _get_figure(kind, figsize):
+    fig = _figures.get(kind)
+    if fig is None:
+        fig = plt.figure(figsize=figsize)
+        _figures[kind] = fig
+    else:
+        fig.clf()
+    return fig
+
+
+def plot_timeseries(output, timeseries, fit, dpi=None): # the fMRI timeseries in the ROI and its polynomial fit
+    fig = _get_figure('timeseries', (10, 10))
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_title('fMRI timeseries and polynomial fit',fontsize=20)
+    ax.set_xlim([0,300])
+    ax.set_xlabel('Time (in TRs)',fontsize=20)
+    ax.set_ylabel('Intensity',fontsize=20)
+    ax.plot(timeseries,label='Timeseries in mask')
+    ax.plot(fit,label='Polynomial fit')
+    ax.legend(fontsize = 'large')
+    fig.savefig(output, dpi=dpi or 500, bbox_inches = 'tight')
+
+
+def plot_weisskoff(output, widths, fluctuations, rdc, dpi=None): # fluctuation against ROI width, with the ideal 1/n decay
+    fig = _get_figure('weisskoff', (10, 10))
+    ax = fig.add_subplot(1, 1, 1)
+    widths = np.asarray(widths)
+    ax.loglog(widths, fluctuations, 'o-', label='Measured')
+    ax.loglog(widths, fluctuations[0]*widths[0]/widths, '--', label='Ideal (1/n)')
+    ax.set_title('Weisskoff plot, RDC = %.1f voxels' % rdc,fontsize=20)
+    ax.set_xlabel('ROI width (voxels)',fontsize=20)
+    ax.set_ylabel('Fluctuation (%)',fontsize=20)
+    ax.legend(fontsize = 'large')
+    fig.savefig(output, dpi=dpi or 100, bbox_inches = 'tight')
+
+
+def plot_tsnr(output, tsnr_img, roi, dpi=None): # the tSNR map with the outline of the ROI (list of [start, stop] per axis)
+    if not isinstance(tsnr_img, nib.spatialimages.SpatialImage):
+        tsnr_img = nib.load(tsnr_img)
+    tsnr_data = tsnr_img.get_fdata()
+    signal_mask = 0*tsnr_data
+    signal_mask[tuple(slice(start, stop) for start, stop in roi)] = 1
+    tsnr_mask_img = new_img_like(tsnr_img, tsnr_data*signal_mask)
+    display = plot_anat(tsnr_img, draw_cross=False, figure=_get_figure('tsnr', None))
+    display.add_contours(tsnr_mask_img, contours=1, antialiased=False,
+                     linewidths=1., levels=[0], colors=['red'])
+    display.savefig(output, dpi=dpi)
+
+
+def plot_coil(output, source, title, dpi=None): # one axial slice of a coil image
+    display = plot_anat(anat_img=load_nifti(source), display_mode='z', cut_coords=1, title=title,
+                        figure=_get_figure('coil', None))
+    display.savefig(output, dpi=dpi)
+
+
+def write_png(output, image):
+    """ Writes an 8-bit grayscale (rows x columns) or RGB (rows x columns x 3) array as a PNG file, without matplotlib."""
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    rows = np.concatenate([np.zeros((height, 1), np.uint8), image.reshape(height, -1)], axis=1) # filter type 0 per row
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 0 if image.ndim == 2 else 2, 0, 0, 0)
+    with open(output, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+def axial_slice(img, index=None):
+    """ Reads one axial slice through the array proxy (not the whole volume) and orients it for display.
+
+    Parameters:
+        img : a nibabel image
+        index : the slice index along the voxel axis closest to inferior-superior, None for the middle slice
+
+    Returns:
+        plane : a 2D array with anterior at the top and the subject's right on the right (as nilearn shows it)
+    """
+    orientation = nib.io_orientation(img.affine) # world axis and direction of each voxel axis
+    axial = int(np.flatnonzero(orientation[:, 0] == 2)[0])
+    in_plane = [axis for axis in range(3) if axis != axial]
+    slicer = [slice(None)] * 3
+    slicer[axial] = img.shape[axial] // 2 if index is None else index
+    plane = np.asarray(img.dataobj[tuple(slicer)], dtype=float)
+    for position, axis in enumerate(in_plane):
+        if orientation[axis, 1] < 0:
+            plane = np.flip(plane, position)
+    if orientation[in_plane[0], 0] != 0: # make the first axis left-right
+        plane = plane.T
+    return plane.T[::-1]
+
+
+def window_slice(plane, percentiles=(1, 99), scale=1, cmap='gray'):
+    """ Windows a slice to 8 bits between two intensity percentiles, enlarges it (nearest neighbour) and applies a color map."""
+    vmin, vmax = np.percentile(plane, percentiles)
+    image = np.clip((plane - vmin) / max(vmax - vmin, 1e-12), 0, 1)
+    image = np.round(image * 255).astype(np.uint8)
+    image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+    if cmap == 'gray':
+        return image
+    lut = np.round(plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8) # no figure needed
+    return lut[image]
+
+
+def plot_coil_thumbnails(output, sources, tiles, columns=8, scale=4, cmap='gray', dpi=None):
+    """ Renders the middle axial slice of every coil image of a session as a tile, and all tiles as one montage (output)."""
+    images = list()
+    for source, tile in zip(sources, tiles):
+        image = window_slice(axial_slice(load_nifti(source)), scale=scale, cmap=cmap)
+        write_png(tile, image)
+        images.append(image)
+    height = max(image.shape[0] for image in images)
+    width = max(image.shape[1] for image in images)
+    rows = -(-len(images) // columns)
+    montage = np.zeros((rows * height, columns * width) + images[0].shape[2:], np.uint8)
+    for i, image in enumerate(images):
+        row, column = divmod(i, columns)
+        montage[row*height:row*height + image.shape[0], column*width:column*width + image.shape[1]] = image
+    write_png(output, montage)
+
+
+renderers = {'timeseries': plot_timeseries, 'weisskoff': plot_weisskoff, 'tsnr': plot_tsnr, 'coil': plot_coil,
+             'coil_thumbnails': plot_coil_thumbnails}
+
+
+def render(kind, output, dpi=None, **inputs): # renders one figure with the renderer of its kind
+    with _render_lock, traced('plot', output, kind=kind):
+        renderers[kind](output, dpi=dpi, **inputs)
+
+
+def render_job_file(job_file, dpi=None):
+    """ Renders the figure described by a queued job file and removes the job (and its aliases) from the queue.
+    The figure gets the resolution it was queued with, dpi is only used for jobs queued without one."""
+    try:
+        with open(job_file) as f:
+            job = json.load(f)
+    except FileNotFoundError: # rendered by another process in the meantime
+        return
+    aliases = job.pop('aliases', [])
+    job['dpi'] = job.get('dpi', dpi)
+    render(job.pop('kind'), **job)
+    for queued_file in [job_file] + aliases:
+        try:
+            os.remove(queued_file)
+        except FileNotFoundError:
+            pass
+
+
+class RenderQueue:
+    """ Decides when the QC figures are rendered.
+
+    In 'inline' mode a figure is rendered as soon as it is submitted (in the process that computed it).
+    In 'deferred' and 'lazy' mode the job is written as a small JSON file to the queue directory instead:
+    deferred jobs are rendered in a worker pool by render_pending at the end of the run, lazy jobs are left
+    in the queue until the figure is first needed (ensure_rendered), e.g. when a report is opened.
+    The inputs of queued jobs must be JSON serializable (file paths instead of images).
+
+    Parameters:
+        queue_dir : the directory holding the queued jobs (not needed in inline mode)
+        mode : 'inline', 'deferred' or 'lazy'
+        dpi : the resolution of the figures, None for the defaults of each figure
+        thumbnails : 'nilearn' to plot each coil image with nilearn, 'fast' to write slice-only tiles and a montage per session
+    """
+
+    def __init__(self, queue_dir=None, mode='inline', dpi=None, thumbnails='nilearn'):
+        if mode not in render_modes:
+            raise ValueError('Unknown render mode %s, use one of %s' % (mode, ', '.join(render_modes)))
+        self.queue_dir = None if queue_dir is None else Path(queue_dir)
+        self.mode = mode
+        self.dpi = dpi
+        self.thumbnails = thumbnails
+
+    def job_file(self, output, suffix='.json'):
+        return self.queue_dir.joinpath(hashlib.sha1(Path(output).as_posix().encode()).hexdigest() + suffix)
+
+    def submit(self, kind, output, products=(), **inputs):
+        """ Renders the figure to output now (inline) or queues it.
+
+        products are further files written by the same job; they get alias entries in the queue,
+        so that ensure_rendered also works for them.
+        """
+        if self.mode == 'inline':
+            render(kind, output, dpi=self.dpi, **inputs)
+            return
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        job_file = self.job_file(output)
+        aliases = [self.job_file(product, '.alias') for product in products]
+        for alias in aliases:
+            alias.write_text(job_file.name)
+        tmp_file = job_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(kind=kind, output=Path(output).as_posix(), dpi=self.dpi, aliases=[alias.as_posix() for alias in aliases], **inputs), f)
+        os.replace(tmp_file, job_file)
+
+    def pending(self):
+        """ Returns the job files in the queue."""
+        if self.queue_dir is None or not self.queue_dir.exists():
+            return []
+        return sorted(self.queue_dir.glob('*.json'))
+
+    def render_pending(self, jobs=1):
+        """ Renders all queued figures, in a pool of jobs worker processes."""
+        parallel_map(partial(render_job_file, dpi=self.dpi), self.pending(), jobs)
+
+    def ensure_rendered(self, output):
+        """ Renders output from the queue if it is not there yet; returns whether the file exists."""
+        if not Path(output).exists() and self.queue_dir is not None:
+            if self.job_file(output, '.alias').exists():
+                try:
+                    render_job_file(self.queue_dir.joinpath(self.job_file(output, '.alias').read_text()), self.dpi)
+                except FileNotFoundError:
+                    pass
+            elif self.job_file(output).exists():
+                render_job_file(self.job_file(output), self.dpi)
+        return Path(output).exists()
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+# the session reports and their images, served over HTTP by the dashboard with caching headers
+
+import gzip
+import hashlib
+import re
+from pathlib import Path
+
+from flask import abort, make_response, request, send_file
+from werkzeug.security import safe_join
+
+from phantom_data import report_url
+
+files_url = '/files'
+image_suffixes = ['.png', '.jpg', '.jpeg', '.gif', '.svg']
+image_max_age = 365 * 24 * 3600 # an image URL with its modification time (?v=...) always shows the same image
+image_source = re.compile(r'(<img\b[^>]*?\bsrc=")([^"]*)(")', re.IGNORECASE)
+
+
+def served_file(default_path, name, suffixes):
+    """ Returns the path of name in default_path, aborts with 404 if it is outside of it or not one of the suffixes."""
+    path = safe_join(str(default_path), name)
+    if path is None or Path(path).suffix.lower() not in suffixes:
+        abort(404)
+    return Path(path)
+
+
+def image_url(default_path, report, source):
+    """ Returns the URL of an image of a report (the src of an img tag), with the modification time of the image
+    if it exists (so that it can be cached for good) and unchanged if the image is not in default_path.
+
+    Returns:
+        url : the URL
+        mtime : the modification time of the image in seconds, None if it does not exist (yet)
+    """
+    path = Path(source) if Path(source).is_absolute() else report.parent.joinpath(source)
+    try:
+        name = path.relative_to(default_path).as_posix()
+    except ValueError:
+        return source, None
+    if not path.exists(): # queued (see phantom_render.py), rendered when it is requested
+        return '%s/%s' % (files_url, name), None
+    mtime = path.stat().st_mtime_ns
+    return '%s/%s?v=%i' % (files_url, name, mtime), mtime / 1e9
+
+
+def text_response(body, mimetype, last_modified):
+    """ Returns the body with an ETag and Last-Modified, revalidated at each use (304 if unchanged),
+    gzipped if the client accepts it."""
+    etag = hashlib.sha1(body).hexdigest()
+    compress = 'gzip' in request.accept_encodings
+    if compress:
+        body = gzip.compress(body)
+        etag += '-gzip'
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    response.vary.add('Accept-Encoding')
+    if compress:
+        response.content_encoding = 'gzip'
+    return response.make_conditional(request)
+
+
+def add_report_routes(server, default_path, renderer=None):
+    """ Adds the routes of the reports and their images to the Flask server of the dashboard.
+
+    <report_url>/<name> serves a report (an html file in default_path) with the sources of its images replaced by
+    their URLs; <files_url>/<name> serves an image in default_path, rendered first if it is in the queue of the
+    renderer (lazy rendering, see RenderQueue). Images requested with their modification time are cached by the
+    browser for a year, everything else is revalidated with its ETag and Last-Modified.
+
+    Parameters:
+        server : the Flask server (app.server of Dash)
+        default_path : the BIDS directory
+        renderer : the RenderQueue of the queued figures, None to serve only existing images
+    """
+
+    @server.route('%s/<path:name>' % report_url)
+    def report(name):
+        path = served_file(default_path, name, ['.html'])
+        if not path.exists():
+            abort(404)
+        mtimes = [path.stat().st_mtime]
+
+        def replace(match):
+            url, mtime = image_url(default_path, path, match.group(2))
+            mtimes.append(mtime or 0)
+            return match.group(1) + url + match.group(3)
+        body = image_source.sub(replace, path.read_text()).encode()
+        return text_response(body, 'text/html', max(mtimes))
+
+    @server.route('%s/<path:name>' % files_url)
+    def image(name):
+        path = served_file(default_path, name, image_suffixes)
+        if not (renderer.ensure_rendered(path) if renderer is not None else path.exists()):
+            abort(404)
+        versioned = request.args.get('v') == str(path.stat().st_mtime_ns)
+        response = send_file(path, max_age=image_max_age if versioned else 0, conditional=True, etag=True)
+        response.cache_control.immutable = versioned
+        return response
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# timing and memory trace of the preprocessing: wall time, CPU time, bytes read and peak memory per stage and file
+
+import atexit
+import json
+import os
+import resource
+import shutil
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+# the trace is configured through an environment variable, so that worker processes write to the same trace
+TRACE_DIR_VARIABLE = 'PHANTOM_TRACE_DIR'
+
+_write_lock = threading.Lock()
+_peak_lock = threading.Lock()
+_stage_peaks = dict() # peak memory (MB) of the stages in progress in this process before the last reset, by stage
+
+
+def enabled():
+    return os.environ.get(TRACE_DIR_VARIABLE) is not None
+
+
+def process_counters():
+    """ Returns the CPU time (s), the bytes read (all reads, also from the page cache, and those from the disk)
+    and the current and peak resident memory (MB) of this process. Byte counts are None without /proc."""
+    counters = {'cpu': time.process_time(), 'read_bytes': None, 'disk_read_bytes': None,
+                'rss_mb': None, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(':') for line in f.read().splitlines())
+        counters['read_bytes'] = int(io['rchar'])
+        counters['disk_read_bytes'] = int(io['read_bytes'])
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f.read().splitlines() if ':' in line)
+        counters['rss_mb'] = int(status['VmRSS'].split()[0]) / 1024
+        counters['peak_rss_mb'] = int(status['VmHWM'].split()[0]) / 1024
+    except (OSError, KeyError, ValueError): # not Linux
+        pass
+    return counters
+
+
+def reset_peak_rss():
+    """ Resets the peak resident memory of this process (VmHWM) to its current resident memory.
+    Returns False if it can't be reset (not Linux), the peak is then the one since the process started."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def traced(name, file=None, **fields):
+    """ Records the stage name (for file, if given) in the trace, if tracing is enabled (see start).
+
+    CPU time, bytes read and peak_rss_mb are those of the whole process during the stage (including its other
+    threads): the peak memory is reset when a stage starts, after adding the peak up to then to the stages in
+    progress, so peak_rss_mb is the largest resident memory between the start and the end of the stage (since the
+    process started if the peak can't be reset, see reset_peak_rss). Further fields (e.g. scanner) are stored
+    with the record. Nothing is recorded if the stage raises.
+    """
+    if not enabled():
+        yield
+        return
+    stage = object()
+    with _peak_lock:
+        peak = process_counters()['peak_rss_mb']
+        for other in _stage_peaks:
+            _stage_peaks[other] = max(_stage_peaks[other], peak)
+        _stage_peaks[stage] = 0 if reset_peak_rss() else peak
+    start, wall_start = process_counters(), time.perf_counter()
+    timestamp = time.time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall_start
+        end = process_counters()
+        with _peak_lock:
+            peak = max(_stage_peaks.pop(stage), end['peak_rss_mb'])
+    record = {'name': name, 'file': None if file is None else Path(file).as_posix(), 'pid': os.getpid(),
+              'thread': threading.get_ident(), 'start': timestamp, 'wall': wall, 'cpu': end['cpu'] - start['cpu'],
+              'read_bytes': None if start['read_bytes'] is None else end['read_bytes'] - start['read_bytes'],
+              'disk_read_bytes': None if start['disk_read_bytes'] is None else end['disk_read_bytes'] - start['disk_read_bytes'],
+              'rss_mb': end['rss_mb'], 'peak_rss_mb': peak}
+    record.update(fields)
+    trace_dir = Path(os.environ[TRACE_DIR_VARIABLE])
+    with _write_lock: # one part file per process, so processes never write to the same file
+        with open(trace_dir.joinpath('trace_%i.jsonl' % os.getpid()), 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def read_records(trace_dir):
+    """ Returns the records of all processes, sorted by start time."""
+    records = list()
+    for part in Path(trace_dir).glob('trace_*.jsonl'):
+        with open(part) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record['start'])
+
+
+def write_trace(records, output):
+    """ Writes the records as JSON lines, or as a Chrome trace (chrome://tracing, Perfetto) if output ends with .json."""
+    with open(output, 'w') as f:
+        if Path(output).suffix != '.json':
+            f.writelines(json.dumps(record) + '\n' for record in records)
+            return
+        events = [{'name': record['name'] if record['file'] is None else '%s %s' % (record['name'], Path(record['file']).name),
+                   'cat': record['name'], 'ph': 'X', 'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+                   'pid': record['pid'], 'tid': record['thread'],
+                   'args': {key: value for key, value in record.items() if key not in ('name', 'start', 'wall', 'pid', 'thread')}}
+                  for record in records]
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize(records):
+    """ Returns a table with the total wall and CPU time, bytes read and peak memory per stage, and its slowest file."""
+    stages = defaultdict(list)
+    for record in records:
+        stages[record['name']].append(record)
+    lines = ['%-16s %6s %10s %10s %10s %10s  %s' % ('stage', 'count', 'wall (s)', 'cpu (s)', 'read (MB)', 'peak (MB)', 'slowest')]
+    for name, stage_records in sorted(stages.items(), key=lambda item: -sum(record['wall'] for record in item[1])):
+        slowest = max(stage_records, key=lambda record: record['wall'])
+        lines.append('%-16s %6i %10.2f %10.2f %10.1f %10.1f  %s' % (
+            name, len(stage_records), sum(record['wall'] for record in stage_records), sum(record['cpu'] for record in stage_records),
+            sum(record['read_bytes'] or 0 for record in stage_records) / 2**20, max(record['peak_rss_mb'] for record in stage_records),
+            '%.2f s %s' % (slowest['wall'], slowest['file'] or '')))
+    return '\n'.join(lines)
+
+
+def start(output):
+    """ Enables the trace in this process and its worker processes; the trace is written to output (see write_trace)
+    and summarized when this process exits."""
+    trace_dir = Path(output).with_name(Path(output).name + '.parts')
+    shutil.rmtree(trace_dir, ignore_errors=True) # parts of an earlier, interrupted run
+    trace_dir.mkdir(parents=True)
+    os.environ[TRACE_DIR_VARIABLE] = trace_dir.as_posix()
+    atexit.register(finish, output, os.getpid())
+
+
+def finish(output, pid):
+    if os.getpid() != pid: # a forked worker process
+        return
+    trace_dir = Path(os.environ.pop(TRACE_DIR_VARIABLE))
+    records = read_records(trace_dir)
+    write_trace(records, output)
+    shutil.rmtree(trace_dir, ignore_errors=True)
+    print(summarize(records))
+    print('Trace written to %s' % output)
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# persistent index of the phantom NIfTI files in the BIDS tree, so that the tree is not globbed
+# and the file names are not date parsed again for every lookup
+
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import warnings
+from pathlib import Path
+
+index_version = 1 # increase when the stored entities change, this rebuilds the index
+
+# sub-<scanner>_ses-<YYYYMMDD>_<key>-<value>_..._<suffix>.nii.gz (derived files such as _bold_tsnr.nii.gz don't match)
+file_pattern = re.compile(r'sub-(?P<scanner>[a-zA-Z0-9]+)_ses-(?P<date>\d{8})_(?P<entities>(?:[a-zA-Z]+-[a-zA-Z0-9]+_)*)(?P<suffix>[a-zA-Z0-9]+)\.nii\.gz$')
+entity_pattern = re.compile(r'([a-zA-Z]+)-([a-zA-Z0-9]+)_')
+coil_pattern = re.compile(r'grecoilCheck(?:C|cH)(\d+)$')
+date_pattern = re.compile(r'(\d{4})(\d{2})(\d{2})$')
+datatypes = ['anat', 'func'] # the BIDS datatype directories that are indexed
+
+# directories modified this recently may still be receiving files, they are listed again at the next refresh
+settle_time = 2
+
+
+def parse_date(date):
+    """ Parses a YYYYMMDD date (string or int) strictly; raises ValueError for anything else."""
+    match = date_pattern.match(str(date))
+    if match is None:
+        raise ValueError('%s is not a YYYYMMDD date' % date)
+    return datetime.date(*map(int, match.groups()))
+
+
+def parse_file_name(name):
+    """ Returns the BIDS entities of a NIfTI file name as a dict, or None if the name does not match.
+
+    The coil number is taken from acq-grecoilCheckC<nn> or acq-grecoilCheckcH<n> (None for other files).
+    """
+    match = file_pattern.match(name)
+    if match is None:
+        return None
+    entities = dict(entity_pattern.findall(match.group('entities')))
+    coil = coil_pattern.match(entities.get('acq', ''))
+    return {'scanner': match.group('scanner'),
+            'date': match.group('date'),
+            'task': entities.get('task'),
+            'acq': entities.get('acq'),
+            'run': entities.get('run'),
+            'echo': entities.get('echo'),
+            'coil': None if coil is None else int(coil.group(1)),
+            'suffix': match.group('suffix')}
+
+
+class SessionIndex:
+    """ The NIfTI files of one scanner (sub-<scanner>) and their BIDS entities, kept in a JSON file.
+
+    refresh only lists the directories whose modification time changed since they were last listed:
+    the subject directory (sessions added or removed), the session directories (datatype directories)
+    and the anat and func directories (files added, renamed or removed). Unchanged directories are
+    only stat'ed.
+
+    Parameters:
+        root : the BIDS directory
+        scanner : the scanner, i.e. the BIDS subject
+    """
+
+    def __init__(self, root, scanner):
+        self.root = Path(root)
+        self.scanner = scanner
+        self.index_file = self.root.joinpath('session_index_%s.json' % scanner) # not in sub-<scanner>, saving it would modify the directory
+        self.directories = dict() # relative directory path -> {'mtime_ns': ..., 'children': [...]} or {'mtime_ns': ..., 'files': {...}}
+        if self.index_file.exists():
+            with open(self.index_file) as f:
+                stored = json.load(f)
+            if stored.get('version') == index_version:
+                self.directories = stored['directories']
+        self.changed = False
+        self._entries = None
+
+    def _listing(self, directory, listed, scan):
+        """ Returns the stored listing of a directory, or a new one from scan(directory path) if it was modified."""
+        try:
+            mtime_ns = os.stat(self.root.joinpath(directory)).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        stored = self.directories.get(directory)
+        if stored is not None and stored['mtime_ns'] == mtime_ns:
+            listed[directory] = stored
+            return stored
+        listing = scan(self.root.joinpath(directory))
+        listing['mtime_ns'] = mtime_ns if time.time() - mtime_ns / 1e9 > settle_time else None
+        listed[directory] = listing
+        self.changed = True
+        return listing
+
+    def _scan_children(self, path, names):
+        return {'children': sorted(entry.name for entry in os.scandir(path) if entry.is_dir() and names(entry.name))}
+
+    def _scan_files(self, path):
+        files = dict()
+        for entry in os.scandir(path):
+            entities = parse_file_name(entry.name)
+            if entities is None:
+                continue
+            try:
+                parse_date(entities['date'])
+            except ValueError:
+                warnings.warn('Invalid session date in %s, not indexed' % Path(path).joinpath(entry.name).as_posix())
+                continue
+            files[entry.name] = entities
+        return {'files': files}
+
+    def refresh(self):
+        """ Updates the index from the modified directories and saves it if anything changed."""
+        listed = dict()
+        subject = 'sub-' + self.scanner
+        sessions = self._listing(subject, listed, lambda path: self._scan_children(path, lambda name: name.startswith('ses-')))
+        for session in (sessions or {'children': []})['children']:
+            session_dir = subject + '/' + session
+            present = self._listing(session_dir, listed, lambda path: self._scan_children(path, lambda name: name in datatypes))
+            for datatype in (present or {'children': []})['children']:
+                self._listing(session_dir + '/' + datatype, listed, self._scan_files)
+        if listed.keys() != self.directories.keys(): # removed directories
+            self.changed = True
+        self.directories = listed
+        self._entries = None
+        self.save()
+
+    def save(self):
+        """ Writes the index (through a temporary file, other processes may be reading it)."""
+        if not self.changed:
+            return
+        tmp_file = self.index_file.with_name('%s.%i.tmp' % (self.index_file.name, os.getpid()))
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': index_version, 'directories': self.directories}, f)
+        os.replace(tmp_file, self.index_file)
+        self.changed = False
+
+    def entries(self):
+        """ Returns a dict of all indexed files (absolute Path) with their entities and datatype, in path order."""
+        if self._entries is None:
+            self._entries = dict()
+            for directory in sorted(self.directories):
+                listing = self.directories[directory]
+                for name in sorted(listing.get('files', [])):
+                    self._entries[self.root.joinpath(directory, name)] = dict(listing['files'][name], datatype=Path(directory).name)
+        return self._entries
+
+    def select(self, datatype=None, after=None, before=None, **entities):
+        """ Returns the indexed files as (path, entities) pairs, optionally filtered.
+
+        Parameters:
+            datatype : 'anat' or 'func'
+            after, before : only sessions strictly after / before this date (YYYYMMDD string or int)
+            entities : required entity values, e.g. date='20220101', run='1' or coil=5
+
+        Returns:
+            a list of (path, entities) in path order
+        """
+        after = None if after is None else parse_date(after).strftime('%Y%m%d') # YYYYMMDD strings sort like the dates
+        before = None if before is None else parse_date(before).strftime('%Y%m%d')
+        return [(path, entry) for path, entry in self.entries().items()
+                if (datatype is None or entry['datatype'] == datatype)
+                and (after is None or entry['date'] > after)
+                and (before is None or entry['date'] < before)
+                and all(entry[key] == value for key, value in entities.items())]
+
+    def lookup(self, file):
+        """ Returns the entities of an indexed file."""
+        return self.entries()[Path(file)]
+
+
+_indexes = dict() # the indexes used in this process, refreshed once
+_indexes_lock = threading.Lock() # the pipeline runs stages of the same scanner in threads
+
+
+def get_index(root, scanner):
+    """ Returns the index of a scanner, refreshed at the first use in this process."""
+    key = (Path(root).as_posix(), scanner)
+    with _indexes_lock:
+        if key not in _indexes:
+            index = SessionIndex(root, scanner)
+            index.refresh()
+            _indexes[key] = index
+        return _indexes[key]
+
+
+def lookup(root, file):
+    """ Returns the entities of an indexed file (a path below root/sub-<scanner>), from the index of its scanner."""
+    scanner = Path(file).relative_to(root).parts[0][len('sub-'):]
+    return get_index(root, scanner).lookup(file)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# the streamed reduction of a gzipped run reads all volumes from one open file and stays within its memory ceiling
+
+import tracemalloc
+
+import nibabel as nib
+import numpy as np
+from nibabel import openers
+
+from nifti_mirror import load_nifti
+from phantom_metrics import stream_run_statistics, tsnr_maps
+
+
+def write_run(path, slope=1): # a small int16 run, scaled by slope when read
+    data = np.random.default_rng(0).uniform(100, 2000, (64, 64, 32, 60)).astype(np.int16)
+    img = nib.Nifti1Image(data, np.eye(4))
+    if slope != 1:
+        img.header.set_slope_inter(slope, 0)
+    nib.save(img, path)
+    return data * slope
+
+
+def count_opens(monkeypatch, path): # returns a list that gets an entry whenever nibabel opens path
+    opens = list()
+    init = openers.Opener.__init__
+
+    def counting_init(self, fileish, *args, **kwargs):
+        if str(fileish) == str(path):
+            opens.append(fileish)
+        init(self, fileish, *args, **kwargs)
+
+    monkeypatch.setattr(openers.Opener, '__init__', counting_init)
+    return opens
+
+
+def test_streamed_run_is_opened_once(tmp_path, monkeypatch):
+    path = tmp_path.joinpath('sub-Test_ses-1_task-stability_echo-1_bold.nii.gz')
+    data = write_run(path)
+    opens = count_opens(monkeypatch, path)
+
+    img = load_nifti(path, keep_file_open=True)
+    opens.clear() # the header was read when loading
+    mean, stddev, coms = stream_run_statistics(img.dataobj, chunk_size=3)
+
+    assert len(opens) == 1
+    _, full_mean, full_stddev = tsnr_maps(data.astype(np.float64))
+    np.testing.assert_allclose(mean, full_mean, rtol=1e-6)
+    np.testing.assert_allclose(stddev, full_stddev, rtol=1e-5)
+    assert coms.shape == (60, 3)
+
+
+def test_streamed_run_stays_within_max_memory(tmp_path):
+    path = tmp_path.joinpath('sub-Test_ses-1_task-stability_echo-1_bold.nii.gz')
+    data = write_run(path, slope=2) # nibabel returns the volumes of a scaled run as float64
+    img = load_nifti(path, keep_file_open=True)
+    max_memory = 8 * 2**20
+
+    tracemalloc.start()
+    mean, stddev, coms = stream_run_statistics(img.dataobj, precision=np.float32, max_memory=max_memory)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert peak <= max_memory
+    np.testing.assert_allclose(mean, data.mean(axis=-1), rtol=1e-5)